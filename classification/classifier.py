@@ -1,32 +1,76 @@
+from contextlib import nullcontext
 from typing import List
 from classification.schema import ClassificationSchema
 from classification.result import ClassificationResult
-from utils.translate import translate_text
-from transformers import pipeline
-from openai import AzureOpenAI
+from utils.translate import translate_text, translate_texts
+from utils.resilience import get_breaker, get_timeout
+from classification.models import model_pool
+from classification.scheduler import inference_scheduler
+from utils.cache import LRUCache, make_cache
+from utils.cosmos import cosmos_source_id
+from utils.logger import log_fields
+from classification.supervised import supervised_registry
 from fuzzywuzzy import process
+import hashlib
+import threading
 import os
 
-# initialize classifier client
-if os.getenv("CLASSIFIER_PROVIDER") == "HuggingFace":
-    hf_classifier = pipeline(
-        "zero-shot-classification", model=os.getenv("CLASSIFIER_MODEL")
-    )
-elif os.getenv("CLASSIFIER_PROVIDER") == "OpenAI":
-    client = AzureOpenAI(
-        api_version="2024-12-01-preview",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    )
+# classifier client, initialized on first use (see get_openai_client)
+openai_client_ = None
+clients_lock = threading.Lock()
+# premise-hypothesis pairs classified per inference slot when classifying many texts
+INFERENCE_CHUNK_SIZE = int(os.getenv("INFERENCE_CHUNK_SIZE", 32))
+# classification results by schema version and text, shared by instances if CACHE_BACKEND is redis
+result_cache = make_cache(
+    "result",
+    max_size=int(os.getenv("RESULT_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", 24 * 3600)),
+)
 
 
-def classify_text(text: str, classes: List[str]) -> str | None:
+def get_hf_classifier(model: str = None):
+    """Get the HuggingFace zero-shot engine of a model, load it on first use."""
+    return model_pool.get(model or os.getenv("CLASSIFIER_MODEL"))
+
+
+def get_openai_client():
+    """Get the Azure OpenAI client, create it on first use."""
+    global openai_client_
+    if openai_client_ is None:
+        with clients_lock:
+            if openai_client_ is None:
+                from openai import AzureOpenAI
+
+                openai_client_ = AzureOpenAI(
+                    api_version="2024-12-01-preview",
+                    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                )
+    return openai_client_
+
+
+def warmup_classifier():
+    """
+    Initialize the classifier client and, for HuggingFace, run one inference
+    so that the first request does not pay for loading the model.
+    """
+    if os.getenv("CLASSIFIER_PROVIDER") == "HuggingFace":
+        classify_text("warmup", ["warmup", "test"])
+    elif os.getenv("CLASSIFIER_PROVIDER") == "OpenAI":
+        get_openai_client()
+
+
+def classify_text(
+    text: str, classes: List[str], provider: str = None, model: str = None
+) -> str | None:
     """
     Classify text using the classification model.
 
     Args:
         text (str): The text to classify.
         classes (list): List of classes to classify against.
+        provider (str): Classifier provider, CLASSIFIER_PROVIDER if not given.
+        model (str): Classifier model, CLASSIFIER_MODEL if not given.
 
     Returns:
         str: Predicted class or None if no classes are provided.
@@ -37,20 +81,15 @@ def classify_text(text: str, classes: List[str]) -> str | None:
     elif len(classes) == 1:
         return classes[0]
 
+    provider = provider or os.getenv("CLASSIFIER_PROVIDER")
+    model = model or os.getenv("CLASSIFIER_MODEL")
     predicted_class = ""
-    if os.getenv("CLASSIFIER_PROVIDER") == "HuggingFace":
-        prompt = "This text is about {}"
-        output = hf_classifier(
-            text,
-            classes,
-            hypothesis_template=prompt,
-            multi_label=False,
-        )
-        predicted_class = output["labels"][
-            output["scores"].index(max(output["scores"]))
-        ]
-    elif os.getenv("CLASSIFIER_PROVIDER") == "OpenAI":
-        response = client.chat.completions.create(
+    if provider == "HuggingFace":
+        predicted_class = get_hf_classifier(model).predict([text], classes)[0]
+    elif provider == "OpenAI":
+        client = get_openai_client().with_options(timeout=get_timeout("openai"))
+        response = get_breaker("openai").call(
+            client.chat.completions.create,
             messages=[
                 {
                     "role": "system",
@@ -60,13 +99,13 @@ def classify_text(text: str, classes: List[str]) -> str | None:
                 },
                 {
                     "role": "user",
-                    "content": f"I suggest you contact the communities first before distributing aid.",
+                    "content": text,
                 },
             ],
             max_completion_tokens=50,
             temperature=0.2,
             top_p=0.1,
-            model=os.getenv("CLASSIFIER_MODEL"),
+            model=model,
         )
         predicted_class = response.choices[0].message.content.strip()
         # fuzzy-match the closest class, to ensure the predicted class is one of the input classes
@@ -74,37 +113,244 @@ def classify_text(text: str, classes: List[str]) -> str | None:
     return predicted_class
 
 
+def classify_texts(
+    texts: List[str],
+    classes: List[str],
+    provider: str = None,
+    model: str = None,
+    batch_size: int = None,
+) -> List[str | None]:
+    """
+    Classify multiple texts against the same classes.
+
+    Args:
+        texts (list): The texts to classify.
+        classes (list): List of classes to classify against.
+        provider (str): Classifier provider, CLASSIFIER_PROVIDER if not given.
+        model (str): Classifier model, CLASSIFIER_MODEL if not given.
+        batch_size (int): Number of premise-hypothesis pairs per forward pass,
+            ZERO_SHOT_BATCH_SIZE if not given.
+
+    Returns:
+        list: Predicted class for each text, None if no classes are provided.
+    """
+    if len(classes) == 0:
+        return [None] * len(texts)
+    elif len(classes) == 1:
+        return [classes[0]] * len(texts)
+
+    provider = provider or os.getenv("CLASSIFIER_PROVIDER")
+    if provider == "HuggingFace":
+        return get_hf_classifier(model).predict(texts, classes, batch_size)
+    # no native batching for chat completions, classify one by one
+    return [classify_text(text, classes, provider, model) for text in texts]
+
+
 class Classifier:
     """
     Classifier base class
     """
 
-    def __init__(self, schema: ClassificationSchema, translate: bool = False):
+    def __init__(
+        self,
+        schema: ClassificationSchema,
+        translate: bool = False,
+        lane: str = "interactive",
+        supervised: bool = True,
+        cache: bool = True,
+    ):
         self.schema = schema
         self.translate = translate
+        self.provider = schema.get_provider()  # classifier provider of the schema
+        self.model = schema.get_model()  # classifier model of the schema
+        self.lane = lane  # scheduling lane: interactive, batch or backfill
+        self.source = schema.settings.get("source-origin")
+        # model trained on the labeled records of this schema version, if any;
+        # texts it cannot classify confidently are classified zero-shot
+        self.supervised = supervised_registry.get(schema) if supervised else None
+        # results classified before; without cache (size 0), every text is classified
+        self.result_cache = result_cache if cache else LRUCache("result", max_size=0)
+        self.labels_en = {
+            (record.level, record.id): record.label_en for record in schema.data
+        }
+
+    def get_children(self, level: int, parent_id: str | None) -> List[str]:
+        """Get the class ids of a level under a parent class."""
+        compiled = self.schema.get_compiled()
+        return [
+            compiled.ids[compiled.index_en[label_en]]
+            for label_en in compiled.children.get((level, parent_id), [])
+        ]
+
+    def predict_supervised(self, text: str) -> List[str]:
+        """
+        Classify text with the supervised model, return the English labels
+        of the levels predicted confidently, from level 1
+        """
+        if self.supervised is None:
+            return []
+        class_ids = self.supervised.predict(text, self.get_children)
+        return [
+            self.labels_en[(level, class_id)]
+            for level, class_id in enumerate(class_ids, start=1)
+        ]
+
+    def predict_levels(self, text: str, predicted: List[str]) -> List[str | None]:
+        """
+        Classify text zero-shot at the levels after those already predicted,
+        each among the children of the label predicted at the level above
+        """
+        predicted = list(predicted)
+        for level in range(len(predicted) + 1, self.schema.n_levels + 1):
+            if predicted and not predicted[-1]:
+                break
+            parent = self.schema.get_class_id(predicted[-1]) if predicted else None
+            labels = self.schema.get_labels_en(level=level, parent=parent)
+            predicted.append(self.predict(text, labels))
+        return predicted
+
+    def slot(self, labels: List[str]):
+        """
+        Get an inference slot from the scheduler for local (HuggingFace) inference;
+        remote calls (OpenAI) and single candidate labels need no CPU, nor a slot
+        """
+        if self.provider == "HuggingFace" and len(labels) > 1:
+            return inference_scheduler.slot(self.lane, self.source)
+        return nullcontext()
+
+    def predict(self, text: str, labels: List[str]) -> str | None:
+        """Classify one text, once the scheduler grants an inference slot if needed."""
+        with self.slot(labels):
+            return classify_text(text, labels, self.provider, self.model)
+
+    def predict_many(self, texts: List[str], labels: List[str]) -> List[str | None]:
+        """
+        Classify many texts, in chunks of about INFERENCE_CHUNK_SIZE premise-hypothesis
+        pairs, each in its own inference slot, so that webhooks get a slot between chunks
+        """
+        chunk_size = max(1, INFERENCE_CHUNK_SIZE // max(len(labels), 1))
+        predicted = []
+        for start in range(0, len(texts), chunk_size):
+            with self.slot(labels):
+                predicted += classify_texts(
+                    texts[start : start + chunk_size], labels, self.provider, self.model
+                )
+        return predicted
+
+    def warmup(self):
+        """
+        Load the model of the schema, tokenize the candidate labels of every level
+        and run one inference, so that the first request is as fast as the next ones
+        """
+        if self.provider == "HuggingFace":
+            engine = get_hf_classifier(self.model)
+            if engine.pretokenized:
+                for labels in self.schema.get_compiled().children.values():
+                    engine.get_hypotheses(list(labels))
+            self.predict_levels("warmup", [])
+        elif self.provider == "OpenAI":
+            get_openai_client()
+
+    def get_result_key(self, text: str) -> str:
+        """Get the cache key of the classification of a text with this schema version and classifier."""
+        source_id = cosmos_source_id(
+            self.schema.source, self.schema.settings["source-origin"]
+        )
+        digest = hashlib.sha256(str(text).encode()).hexdigest()
+        return (
+            f"labels:{self.schema.source.value}:{source_id}:{self.schema.version_id}:"
+            f"{self.provider}:{self.model}:{bool(self.translate)}:"
+            f"{self.supervised.trained_at if self.supervised else None}:{digest}"
+        )
 
     def classify(self, text: str) -> ClassificationResult:
         """
         Classify text based on classification schema
         """
+        key = self.get_result_key(text)
+        cached = self.result_cache.get(key)
+        log_fields(result_cache="hit" if cached is not None else "miss")
+        if cached is not None:
+            return self.get_result(text, *cached)
 
-        labels_1 = self.schema.get_labels_en(level=1)
-        if self.translate:
-            text = translate_text(text)
-        label_1 = classify_text(text, labels_1)
-        label_2, label_3 = None, None
-        if self.schema.n_levels > 1:
-            labels_2 = self.schema.get_labels_en(
-                level=2, parent=self.schema.get_class_id(label_1)
-            )
-            label_2 = classify_text(text, labels_2)
-        if self.schema.n_levels > 2:
-            if label_2:
-                labels_3 = self.schema.get_labels_en(
-                    level=3, parent=self.schema.get_class_id(label_2)
-                )
-                label_3 = classify_text(text, labels_3)
+        predicted = self.predict_supervised(text)
+        log_fields(supervised_levels=len(predicted))
+        if len(predicted) < self.schema.n_levels:
+            text_en = translate_text(text) if self.translate else text
+            predicted = self.predict_levels(text_en, predicted)
+        label_1, label_2, label_3 = (predicted + [None] * 3)[:3]
+
+        # only labels are cached, never the (translated) feedback text
+        self.result_cache.set(key, [label_1, label_2, label_3])
+        return self.get_result(text, label_1, label_2, label_3)
 
+    def classify_batch(self, texts: List[str]) -> List[ClassificationResult]:
+        """
+        Classify multiple texts based on classification schema.
+        Texts classified before are taken from cache, then texts are classified with
+        the supervised model; the levels it does not predict confidently are
+        classified zero-shot, in one call per level and parent label.
+        """
+        keys = [self.get_result_key(text) for text in texts]
+        cached = self.result_cache.get_many(keys)
+        to_classify, supervised = [], {}
+        for key, text in {
+            key: text for key, text in zip(keys, texts) if cached[key] is None
+        }.items():
+            predicted = self.predict_supervised(text)
+            if len(predicted) == self.schema.n_levels:
+                supervised[key] = (predicted + [None] * 3)[:3]
+            else:
+                to_classify.append((key, text, predicted))
+        self.result_cache.set_many(supervised)
+        cached.update(supervised)
+        if to_classify:
+            new_texts = [text for _, text, _ in to_classify]
+            if self.translate:
+                new_texts = translate_texts(new_texts)
+            # continue from the levels predicted by the supervised model, if any
+            predicted = [list(labels) for _, _, labels in to_classify]
+            for level in range(1, self.schema.n_levels + 1):
+                self.classify_by_parent(new_texts, predicted, level=level)
+            classified = {
+                key: (labels + [None] * 3)[:3]
+                for (key, _, _), labels in zip(to_classify, predicted)
+            }
+            self.result_cache.set_many(classified)
+            cached.update(classified)
+
+        return [self.get_result(text, *cached[key]) for key, text in zip(keys, texts)]
+
+    def classify_by_parent(
+        self, texts: List[str], predicted: List[List[str | None]], level: int
+    ):
+        """
+        Classify texts at a given level, those predicted up to the level above,
+        grouping them by the label predicted at the level above; labels are appended
+        to `predicted`, texts without parent label are left as they are
+        """
+        groups = {}
+        for i, labels in enumerate(predicted):
+            if len(labels) == level - 1 and (not labels or labels[-1]):
+                groups.setdefault(labels[-1] if labels else None, []).append(i)
+        for parent_label, indices in groups.items():
+            parent = self.schema.get_class_id(parent_label) if parent_label else None
+            labels = self.schema.get_labels_en(level=level, parent=parent)
+            group_texts = [texts[i] for i in indices]
+            group_labels = self.predict_many(group_texts, labels)
+            for i, label in zip(indices, group_labels):
+                predicted[i].append(label)
+
+    def get_result(
+        self,
+        text: str,
+        label_1: str | None,
+        label_2: str | None = None,
+        label_3: str | None = None,
+    ) -> ClassificationResult:
+        """
+        Map predicted English labels back to the classification schema
+        """
         return ClassificationResult(
             text=text,
             result_level1={
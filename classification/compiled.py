@@ -0,0 +1,62 @@
+from typing import List
+import numpy as np
+
+
+class CompiledSchema:
+    """
+    Data derived from a classification schema: lookup indexes by English label
+    and by parent. Built in memory from the schema records, which takes microseconds.
+    """
+
+    def __init__(
+        self,
+        ids: List[str],
+        labels: List[str],
+        labels_en: List[str],
+        levels: np.ndarray,
+        parents: np.ndarray,
+        version_id: str,
+    ):
+        self.ids = ids  # record IDs
+        self.labels = labels  # record labels
+        self.labels_en = labels_en  # record labels in English
+        self.levels = levels  # record levels (int8)
+        self.parents = parents  # position of the parent record, -1 if none (int32)
+        self.version_id = version_id  # version ID of the schema
+        self.build_indexes()
+
+    def build_indexes(self):
+        """
+        Build lookups by English label and by (level, parent ID)
+        """
+        self.index_en = {}  # label_en -> position of the first record with it
+        self.children = {}  # (level, parent ID or None) -> labels_en
+        for i, label_en in enumerate(self.labels_en):
+            self.index_en.setdefault(label_en, i)
+            level = int(self.levels[i])
+            self.children.setdefault((level, None), []).append(label_en)
+            if self.parents[i] >= 0:
+                parent_id = self.ids[self.parents[i]]
+                self.children.setdefault((level, parent_id), []).append(label_en)
+
+    @classmethod
+    def from_records(cls, records: list, version_id: str):
+        """
+        Compile a list of ClassificationSchemaRecord
+        """
+        # parents are referenced by ID in the level above
+        positions = {(record.level, record.id): i for i, record in enumerate(records)}
+        return cls(
+            ids=[record.id for record in records],
+            labels=[record.label for record in records],
+            labels_en=[record.label_en for record in records],
+            levels=np.array([record.level for record in records], dtype=np.int8),
+            parents=np.array(
+                [
+                    positions.get((record.level - 1, record.parent), -1)
+                    for record in records
+                ],
+                dtype=np.int32,
+            ),
+            version_id=version_id,
+        )
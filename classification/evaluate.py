@@ -0,0 +1,228 @@
+"""
+Offline evaluation of classifier configurations on a labeled dataset.
+
+    python -m classification.evaluate --dataset labeled.csv --schema schema.json \
+        --backend HuggingFace:MoritzLaurer/mDeBERTa-v3-base-mnli-xnli --backend OpenAI:gpt-4o-mini
+
+The dataset is a CSV or JSON lines file with columns `text`, `level1`, `level2`
+and `level3` (expected class ids, empty if not applicable); the schema is a
+classification schema document as saved to CosmosDB.
+Each backend (`<provider>:<model>`) classifies every text through
+Classifier.classify, without result cache, in a process of its own so that
+peak memory is not carried over from the previous backend; accuracy per level,
+throughput, latency percentiles and peak memory are reported.
+"""
+
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import pandas as pd
+import psutil
+from classification.classifier import Classifier
+from classification.models import model_pool
+from classification.schema import ClassificationSchema
+
+
+class PeakMemory:
+    """
+    Sample the resident memory of the process in the background, keep the peak
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval  # time between samples, in seconds
+        self.process = psutil.Process()
+        self.peak = 0  # peak resident memory, in bytes
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+def load_dataset(path: str) -> pd.DataFrame:
+    """Load a labeled dataset from a CSV or JSON lines file."""
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        dataset = pd.read_json(path, lines=True, dtype=str)
+    else:
+        dataset = pd.read_csv(path, dtype=str)
+    if "text" not in dataset.columns:
+        raise ValueError(f"Column 'text' not found in {path}.")
+    for level in ["level1", "level2", "level3"]:
+        if level not in dataset.columns:
+            dataset[level] = None
+    return dataset.where(dataset.notna(), None)
+
+
+def load_schema(path: str, provider: str, model: str) -> ClassificationSchema:
+    """Load a classification schema export, to be classified with a given backend."""
+    with open(path) as file:
+        document = json.load(file)
+    schema = ClassificationSchema(
+        source_settings={
+            "source-name": document["source"],
+            "source-origin": document["id"],
+            "classifier-provider": provider,
+            "classifier-model": model,
+        }
+    )
+    schema.load_from_document(document)
+    return schema
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    """Get a percentile of values, in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(len(values) * q), len(values) - 1)] * 1000, 1)
+
+
+def evaluate(
+    backend: str, schema_path: str, dataset: pd.DataFrame, translate: bool = False
+) -> dict:
+    """
+    Classify every text of the dataset with a backend (`<provider>:<model>`),
+    return accuracy per level, throughput, latency and peak memory
+    """
+    provider, _, model = backend.partition(":")
+    if provider == "HuggingFace" and model:
+        # backends are chosen by whoever runs the evaluation
+        model_pool.allowed_models.add(model)
+    schema = load_schema(schema_path, provider, model or None)
+    # evaluate the zero-shot classifier, not the result cache nor a supervised model
+    classifier = Classifier(
+        schema=schema, translate=translate, lane="batch", supervised=False, cache=False
+    )
+    expected = {level: dataset[f"level{level}"].tolist() for level in [1, 2, 3]}
+    predicted = {level: [] for level in [1, 2, 3]}
+    latencies, n_errors = [], 0
+
+    with PeakMemory() as memory:
+        # first call loads the model, keep it out of the latencies
+        start = time.perf_counter()
+        try:
+            classifier.classify("warmup")
+        except Exception as e:
+            # exceptions of client libraries are not always picklable across processes
+            raise RuntimeError(f"{backend}: failed to load: {e}") from None
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for text in dataset["text"]:
+            call_start = time.perf_counter()
+            try:
+                result = classifier.classify(text or "")
+                ids = [
+                    result.result_level1["id"],
+                    result.result_level2["id"],
+                    result.result_level3["id"],
+                ]
+            except Exception as e:
+                print(f"{backend}: failed to classify '{text}': {e}")
+                n_errors += 1
+                ids = [None, None, None]
+            latencies.append(time.perf_counter() - call_start)
+            for level, id in zip([1, 2, 3], ids):
+                predicted[level].append(id)
+        elapsed = time.perf_counter() - start
+
+    report = {"backend": backend, "texts": len(dataset), "errors": n_errors}
+    for level in [1, 2, 3]:
+        pairs = [
+            (expected_id, predicted_id)
+            for expected_id, predicted_id in zip(expected[level], predicted[level])
+            if expected_id
+        ]
+        report[f"accuracy_level{level}"] = (
+            round(sum(e == p for e, p in pairs) / len(pairs), 3) if pairs else None
+        )
+    report.update(
+        {
+            "texts_per_second": round(len(dataset) / elapsed, 2) if elapsed else None,
+            "latency_p50_ms": percentile(latencies, 0.5),
+            "latency_p95_ms": percentile(latencies, 0.95),
+            "load_s": round(load_time, 2),
+            "peak_rss_mb": round(memory.peak / 1024**2, 1),
+        }
+    )
+    return report
+
+
+def print_reports(reports: List[dict]):
+    """Print reports as a table, one row per backend."""
+    columns = list(reports[0].keys())
+    widths = [
+        max(len(column), *(len(str(report[column])) for report in reports))
+        for column in columns
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for report in reports:
+        print(
+            "  ".join(
+                str(report[column]).ljust(width)
+                for column, width in zip(columns, widths)
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate accuracy and speed of classifier backends on a labeled dataset."
+    )
+    parser.add_argument("--dataset", required=True, help="CSV or JSON lines file")
+    parser.add_argument(
+        "--schema", required=True, help="classification schema export (JSON)"
+    )
+    parser.add_argument(
+        "--backend",
+        action="append",
+        required=True,
+        help="<provider>:<model>, e.g. HuggingFace:facebook/bart-large-mnli; repeat to compare",
+    )
+    parser.add_argument(
+        "--translate", action="store_true", help="translate texts first"
+    )
+    parser.add_argument("--limit", type=int, help="evaluate only the first texts")
+    parser.add_argument("--output", help="save reports to this JSON file")
+    args = parser.parse_args()
+
+    dataset = load_dataset(args.dataset)
+    if args.limit:
+        dataset = dataset.head(args.limit)
+    # a new process per backend, so that each is measured on its own
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1,
+    ) as executor:
+        futures = [
+            executor.submit(
+                evaluate, backend, args.schema, dataset, translate=args.translate
+            )
+            for backend in args.backend
+        ]
+        reports = [future.result() for future in futures]
+    print_reports(reports)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
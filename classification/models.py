@@ -0,0 +1,161 @@
+from collections import OrderedDict
+import threading
+import time
+import os
+from utils.logger import logger
+from classification.zeroshot import ZeroShotEngine
+
+
+def model_size(model) -> int:
+    """Estimate the memory used by a loaded zero-shot engine, in bytes."""
+    try:
+        return sum(p.numel() * p.element_size() for p in model.model.parameters())
+    except AttributeError:
+        return 0
+
+
+class ModelPool:
+    """
+    Pool of HuggingFace zero-shot engines loaded on demand, within a memory budget.
+    When the budget is exceeded, the least recently used models are evicted.
+    Only CLASSIFIER_MODEL and the models in `allowed_models` can be loaded.
+    """
+
+    def __init__(self, budget_mb: float = 4096, allowed_models: list = None):
+        self.budget = int(budget_mb * 1024 * 1024)  # memory budget, in bytes
+        # models that schemas may use besides CLASSIFIER_MODEL
+        self.allowed_models = set(allowed_models or [])
+        self.models = OrderedDict()  # model name -> engine, least recently used first
+        self.sizes = {}  # model name -> estimated size in bytes
+        self.last_used = {}  # model name -> time of last use
+        self.lock = threading.Lock()
+        self.loading = {}  # model name -> lock held while the model is loading
+        self.n_loads = 0
+        self.n_evictions = 0
+
+    def is_allowed(self, model_name: str) -> bool:
+        """
+        Check whether a model may be loaded
+        """
+        return (
+            model_name == os.getenv("CLASSIFIER_MODEL")
+            or model_name in self.allowed_models
+        )
+
+    def get(self, model_name: str):
+        """
+        Get the zero-shot engine of a model, load it if not resident.
+        Raises ValueError if the model is not allowed.
+        """
+        if not self.is_allowed(model_name):
+            raise ValueError(
+                f"Model {model_name} is not allowed, add it to CLASSIFIER_MODELS."
+            )
+        with self.lock:
+            if model_name in self.models:
+                self.models.move_to_end(model_name)
+                self.last_used[model_name] = time.time()
+                return self.models[model_name]
+            loading = self.loading.setdefault(model_name, threading.Lock())
+        # load outside the pool lock, so that other models stay available;
+        # concurrent requests for the same model wait for a single load
+        with loading:
+            try:
+                with self.lock:
+                    if model_name in self.models:
+                        self.models.move_to_end(model_name)
+                        return self.models[model_name]
+                model = self.load(model_name)
+                with self.lock:
+                    self.models[model_name] = model
+                    self.last_used[model_name] = time.time()
+                    self.evict()
+            finally:
+                # also when loading failed, so that failed names do not pile up
+                with self.lock:
+                    self.loading.pop(model_name, None)
+        return model
+
+    def load(self, model_name: str):
+        """
+        Load a model
+        """
+        # importing transformers is slow, only do it when a model is needed
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        start = time.perf_counter()
+        model = ZeroShotEngine(
+            AutoModelForSequenceClassification.from_pretrained(model_name).eval(),
+            AutoTokenizer.from_pretrained(model_name),
+            batch_size=int(os.getenv("ZERO_SHOT_BATCH_SIZE", 32)),
+            window_overlap=int(os.getenv("ZERO_SHOT_WINDOW_OVERLAP", 64)),
+            max_tokens=int(os.getenv("ZERO_SHOT_MAX_TOKENS", 2048)),
+            pooling=os.getenv("ZERO_SHOT_POOLING", "max"),
+        )
+        size = model_size(model)
+        with self.lock:
+            self.sizes[model_name] = size
+            self.n_loads += 1
+        logger.info(
+            f"Loaded model {model_name} ({size / 1024 ** 2:.0f} MB) "
+            f"in {time.perf_counter() - start:.1f}s.",
+        )
+        return model
+
+    def evict(self):
+        """
+        Evict least recently used models until the pool fits in the budget.
+        The most recently used model is never evicted. Must hold the pool lock.
+        """
+        while (
+            len(self.models) > 1
+            and sum(self.sizes.get(name, 0) for name in self.models) > self.budget
+        ):
+            model_name, _ = self.models.popitem(last=False)
+            self.n_evictions += 1
+            logger.info(
+                f"Evicted model {model_name} ({self.sizes[model_name] / 1024 ** 2:.0f} MB) "
+                "to stay within the memory budget.",
+            )
+            self.sizes.pop(model_name, None)
+            self.last_used.pop(model_name, None)
+
+    def is_loaded(self, model_name: str) -> bool:
+        """Check if a model is in memory."""
+        with self.lock:
+            return model_name in self.models
+
+    def resident(self) -> list:
+        """
+        Return the models in memory, most recently used first
+        """
+        with self.lock:
+            return [
+                {
+                    "model": model_name,
+                    "size_mb": round(self.sizes.get(model_name, 0) / 1024**2, 1),
+                    "last_used": self.last_used.get(model_name),
+                }
+                for model_name in reversed(self.models)
+            ]
+
+    def summary(self) -> dict:
+        """
+        Return resident models, budget and counters as a dictionary
+        """
+        return {
+            "resident": self.resident(),
+            "budget_mb": round(self.budget / 1024**2, 1),
+            "loads": self.n_loads,
+            "evictions": self.n_evictions,
+        }
+
+
+model_pool = ModelPool(
+    budget_mb=float(os.getenv("MODEL_POOL_MEMORY_MB", 4096)),
+    allowed_models=[
+        model.strip()
+        for model in os.getenv("CLASSIFIER_MODELS", "").split(",")
+        if model.strip()
+    ],
+)
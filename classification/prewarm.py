@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from classification.classifier import Classifier
+from classification.models import model_pool
+from classification.schema import ClassificationSchema
+from utils.logger import logger
+from utils.schema_store import get_schema_store
+from utils.sources import Source
+
+# number of most recently modified schemas prewarmed at startup, 0 to disable
+SCHEMA_PREWARM_LIMIT = int(os.getenv("SCHEMA_PREWARM_LIMIT", 100))
+# number of schemas prewarmed at once
+SCHEMA_PREWARM_CONCURRENCY = int(os.getenv("SCHEMA_PREWARM_CONCURRENCY", 4))
+
+
+def schema_from_document(document: dict) -> ClassificationSchema:
+    """
+    Build a classification schema from its stored document, with the settings of
+    requests without classifier headers, translating as when the schema was saved
+    """
+    source = Source(document["source"])
+    # documents are stored by source id: Kobo asset id or EspoCRM host
+    origin = document["id"] if source == Source.KOBO else f"https://{document['id']}"
+    schema = ClassificationSchema(
+        source_settings={
+            "source-name": source.value,
+            "source-origin": origin,
+            "translate": document.get("translated", False),
+        }
+    )
+    schema.load_from_document(document)
+    return schema
+
+
+def prewarm_schema(document: dict):
+    """
+    Cache and compile a schema and warm up its classifier. HuggingFace models other
+    than CLASSIFIER_MODEL are not loaded for it, unless they are already in memory,
+    so that prewarming does not fill the model pool with rarely used models.
+    """
+    schema = schema_from_document(document)
+    # requests still check the version at source, with their own authorization
+    schema.save_to_cache(checked=False)
+    classifier = Classifier(schema, lane="backfill")
+    if (
+        classifier.provider == "HuggingFace"
+        and classifier.model != os.getenv("CLASSIFIER_MODEL")
+        and not model_pool.is_loaded(classifier.model)
+    ):
+        schema.get_compiled()
+        return
+    classifier.warmup()
+
+
+def prewarm_schemas():
+    """
+    Prewarm the most recently modified schemas concurrently, so that the first
+    requests after a restart do not pay for reading and compiling them and
+    for loading their models. Best effort: failures are logged, never raised,
+    so that the instance becomes ready without the schemas that failed.
+    """
+    if SCHEMA_PREWARM_LIMIT <= 0:
+        return
+    start = time.perf_counter()
+    try:
+        documents = get_schema_store().list_schemas(SCHEMA_PREWARM_LIMIT)
+    except Exception as e:
+        logger.warning(f"Could not list classification schemas to prewarm: {e}")
+        return
+
+    def run(document: dict) -> bool:
+        try:
+            prewarm_schema(document)
+            return True
+        except Exception as e:
+            logger.warning(f"Could not prewarm schema {document.get('id')}: {e}")
+            return False
+
+    with ThreadPoolExecutor(
+        max_workers=SCHEMA_PREWARM_CONCURRENCY, thread_name_prefix="prewarm"
+    ) as executor:
+        n_prewarmed = sum(executor.map(run, documents))
+    logger.info(
+        f"Prewarmed {n_prewarmed} of {len(documents)} classification schemas "
+        f"in {time.perf_counter() - start:.1f}s."
+    )
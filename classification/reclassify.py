@@ -0,0 +1,202 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import os
+import threading
+import time
+import uuid
+from classification.schema import ClassificationSchema
+from classification.classifier import Classifier
+from classification.result import ClassificationResult
+from utils.espocrm import EspoAPI, link_attribute
+from utils.ratelimit import RateLimiter
+from utils.sources import Source
+from utils.logger import logger
+
+# bulk reclassification jobs of this process, by job id
+jobs = {}
+# how long finished jobs are kept for their status, in seconds
+JOB_TTL = float(os.getenv("JOB_TTL", 24 * 3600))
+
+
+def expire_jobs():
+    """Forget the jobs that finished more than JOB_TTL seconds ago."""
+    now = time.monotonic()
+    for job_id, job in list(jobs.items()):
+        if job.finished_at is not None and now - job.finished_at > JOB_TTL:
+            jobs.pop(job_id, None)
+
+
+class ReclassificationJob:
+    """
+    Bulk reclassification of the records of an EspoCRM entity
+    """
+
+    def __init__(
+        self,
+        schema: ClassificationSchema,
+        entity: str,
+        text_field: str,
+        translate: bool = False,
+        only_outdated: bool = False,
+        version_field: str = None,
+        batch_size: int = 32,
+        concurrency: int = 8,
+        rate_limit: float = 20.0,
+    ):
+        if schema.source != Source.ESPOCRM:
+            raise ValueError("Bulk reclassification is only supported for EspoCRM")
+        self.id = str(uuid.uuid4())
+        self.schema = schema
+        self.entity = entity  # entity to reclassify, e.g. Feedback
+        self.text_field = text_field  # field with the text to classify
+        self.only_outdated = only_outdated  # skip up-to-date records
+        self.version_field = version_field  # field storing the schema version_id
+        self.batch_size = batch_size  # records classified per call
+        self.concurrency = concurrency  # parallel PATCH requests
+        self.classifier = Classifier(
+            schema=schema, translate=translate, lane="backfill"
+        )
+        self.client = EspoAPI(
+            schema.settings["source-origin"], schema.settings["source-authorization"]
+        )
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.lock = threading.Lock()
+        self.status = "pending"
+        self.detail = ""
+        self.n_processed = 0
+        self.n_updated = 0
+        self.n_skipped = 0
+        self.n_failed = 0
+        self.finished_at = None  # monotonic time the job completed or failed
+        expire_jobs()
+        jobs[self.id] = self
+
+    def get_where(self) -> List[dict]:
+        """
+        Get EspoCRM filter selecting the records to reclassify
+        """
+        if not self.only_outdated:
+            return []
+        # unclassified records
+        conditions = [
+            {
+                "type": "isNull",
+                "attribute": link_attribute(self.schema.settings["source-level1"]),
+            }
+        ]
+        # records classified under another version of the schema
+        if self.version_field:
+            conditions += [
+                {"type": "isNull", "attribute": self.version_field},
+                {
+                    "type": "notEquals",
+                    "attribute": self.version_field,
+                    "value": self.schema.version_id,
+                },
+            ]
+        return [{"type": "or", "value": conditions}]
+
+    def get_update(self, result: ClassificationResult) -> dict:
+        """
+        Get the <link>Id fields to write back to the record
+        """
+        update = {}
+        for lvl in range(1, self.schema.n_levels + 1):
+            link = self.schema.settings[f"source-level{lvl}"]
+            if link:
+                update[link_attribute(link)] = result.results()[link + "Id"]
+        if self.version_field:
+            update[self.version_field] = self.schema.version_id
+        return update
+
+    def update_record(self, record_id: str, update: dict):
+        """
+        Update one record, respecting the rate limit
+        """
+        self.rate_limiter.wait()
+        try:
+            response = self.client.request(
+                "PATCH", f"{self.entity}/{record_id}", update
+            )
+            detail = response["detail"] if response["status_code"] != 200 else None
+        except Exception as e:
+            # server errors, timeouts and open circuits fail this record, not the job
+            detail = str(e)
+        with self.lock:
+            if detail is None:
+                self.n_updated += 1
+            else:
+                self.n_failed += 1
+                logger.warning(
+                    f"Failed to update {self.entity} {record_id}: {detail}",
+                    extra=self.schema.get_extra_logs(),
+                )
+
+    def run(self):
+        """
+        Stream records page by page, classify them in batches and write back the results
+        """
+        self.status = "running"
+        logger.info(
+            f"Reclassifying {self.entity} records (job {self.id}).",
+            extra=self.schema.get_extra_logs(),
+        )
+        try:
+            pending = []
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for page in self.client.iter_records(
+                    self.entity,
+                    select=["id", self.text_field],
+                    where=self.get_where(),
+                ):
+                    records = [record for record in page if record.get(self.text_field)]
+                    self.n_skipped += len(page) - len(records)
+                    for start in range(0, len(records), self.batch_size):
+                        batch = records[start : start + self.batch_size]
+                        results = self.classifier.classify_batch(
+                            [record[self.text_field] for record in batch]
+                        )
+                        # write back the previous batch while this one was classified,
+                        # wait for it before queueing more to keep memory bounded
+                        for future in pending:
+                            future.result()
+                        pending = [
+                            executor.submit(
+                                self.update_record,
+                                record["id"],
+                                self.get_update(result),
+                            )
+                            for record, result in zip(batch, results)
+                        ]
+                        self.n_processed += len(batch)
+                for future in pending:
+                    future.result()
+            self.status = "completed"
+        except Exception as e:
+            self.status = "failed"
+            self.detail = str(e)
+            logger.error(
+                f"Reclassification job {self.id} failed: {e}",
+                extra=self.schema.get_extra_logs(),
+            )
+        self.finished_at = time.monotonic()
+        logger.info(
+            f"Reclassification job {self.id} {self.status}: {self.summary()}",
+            extra=self.schema.get_extra_logs(),
+        )
+
+    def summary(self) -> dict:
+        """
+        Return job status and counters as a dictionary
+        """
+        return {
+            "job_id": self.id,
+            "entity": self.entity,
+            "version_id": self.schema.version_id,
+            "status": self.status,
+            "detail": self.detail,
+            "processed": self.n_processed,
+            "updated": self.n_updated,
+            "skipped": self.n_skipped,
+            "failed": self.n_failed,
+        }
@@ -1,7 +1,9 @@
 from fastapi import HTTPException
 import requests
 from utils.sources import Source
-from utils.logger import logger
+from utils.logger import log_fields
+from utils.kobo import KOBO_URL
+from utils.resilience import get_breaker, get_timeout
 from fastapi.responses import JSONResponse
 import json
 
@@ -63,18 +65,33 @@ class ClassificationResult:
             headers = {
                 "Authorization": f"Token {self.settings['source-authorization']}"
             }
-            logger.info(f"Saving classification results to Kobo: {self.results()}")
             kobo_payload = {
                 "submission_ids": [str(payload["_id"])],
                 "data": self.results(),
             }
-            kobo_response = requests.patch(
-                url=f"https://kobo.ifrc.org/api/v2/assets/{self.settings['source-origin']}/data/bulk/",
-                data={"payload": json.dumps(kobo_payload)},
-                params={"fomat": "json"},
-                headers=headers,
-            )
-            kobo_response = kobo_response.json()
+
+            def request():
+                response = requests.patch(
+                    url=f"{KOBO_URL}/api/v2/assets/{self.settings['source-origin']}/data/bulk/",
+                    data={"payload": json.dumps(kobo_payload)},
+                    params={"fomat": "json"},
+                    headers=headers,
+                    timeout=get_timeout("kobo"),
+                )
+                try:
+                    response.raise_for_status()
+                except requests.HTTPError:
+                    # server errors count as failures of Kobo, client errors do not
+                    raise HTTPException(
+                        status_code=(
+                            502 if response.status_code >= 500 else response.status_code
+                        ),
+                        detail=f"Kobo returned {response.status_code} "
+                        f"when saving classification results.",
+                    )
+                return response.json()
+
+            kobo_response = get_breaker("kobo").call(request)
             if (
                 "results" in kobo_response
                 and len(kobo_response["results"]) > 0
@@ -82,6 +99,7 @@ class ClassificationResult:
             ):
                 source_response = kobo_response["results"][0]
                 source_status_code = source_response["status_code"]
+                log_fields(kobo_status_code=source_status_code)
             else:
                 raise HTTPException(
                     status_code=404,
@@ -0,0 +1,161 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+# lanes of inference work and their share of capacity when all are busy
+LANE_WEIGHTS = {
+    "interactive": float(os.getenv("LANE_WEIGHT_INTERACTIVE", 8)),  # webhooks
+    "batch": float(os.getenv("LANE_WEIGHT_BATCH", 2)),  # file uploads
+    "backfill": float(os.getenv("LANE_WEIGHT_BACKFILL", 1)),  # bulk reclassification
+}
+
+
+class InferenceScheduler:
+    """
+    Scheduler in front of inference, so that bulk work cannot starve webhooks.
+    At most `concurrency` inference calls run at once; when more are waiting,
+    lanes get slots in proportion to their weight (stride scheduling) and,
+    within a lane, sources (source-origin) take turns. `reserved` slots are
+    only used by the interactive lane, so that a webhook never waits for bulk
+    work holding all slots.
+    """
+
+    def __init__(self, concurrency: int = 2, weights: dict = None, reserved: int = 1):
+        self.concurrency = concurrency  # maximum number of concurrent inference calls
+        self.weights = weights or LANE_WEIGHTS
+        # slots left to the interactive lane, at least one slot is left to the others
+        self.reserved = max(0, min(reserved, concurrency - 1))
+        self.running = 0  # inference calls running
+        self.running_lanes = {lane: 0 for lane in self.weights}
+        self.passes = {lane: 0.0 for lane in self.weights}  # virtual time of each lane
+        self.virtual_time = 0.0  # virtual time of the last scheduled call
+        # lane -> source -> waiting calls, sources in turn order
+        self.queues = {lane: OrderedDict() for lane in self.weights}
+        self.waits = {lane: deque(maxlen=1000) for lane in self.weights}
+        self.n_calls = {lane: 0 for lane in self.weights}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, lane: str, source: str = None):
+        """
+        Wait for an inference slot in a lane, hold it within the block
+        """
+        self.acquire(lane, source)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def can_run(self, lane: str) -> bool:
+        """Check whether a lane may take a free slot, outside of the reserved ones."""
+        if lane == "interactive":
+            return True
+        n_bulk = sum(
+            running
+            for other, running in self.running_lanes.items()
+            if other != "interactive"
+        )
+        return n_bulk < self.concurrency - self.reserved
+
+    def acquire(self, lane: str, source: str = None):
+        """Wait until an inference slot is granted."""
+        start = time.perf_counter()
+        with self.lock:
+            if (
+                self.running < self.concurrency
+                and self.can_run(lane)
+                and self.peek_lane() is None
+            ):
+                self.running += 1
+                self.running_lanes[lane] += 1
+                event = None
+            else:
+                event = threading.Event()
+                if not self.queues[lane]:
+                    # an idle lane does not accumulate credit
+                    self.passes[lane] = max(self.passes[lane], self.virtual_time)
+                self.queues[lane].setdefault(source, deque()).append(event)
+        if event is not None:
+            event.wait()
+        with self.lock:
+            self.waits[lane].append(time.perf_counter() - start)
+            self.n_calls[lane] += 1
+
+    def release(self, lane: str):
+        """Hand the slot over to the next waiting call that may run, or free it."""
+        with self.lock:
+            self.running_lanes[lane] -= 1
+            next_lane = self.peek_lane()
+            if next_lane is not None:
+                self.running_lanes[next_lane] += 1
+                self.next_waiting(next_lane).set()
+            else:
+                self.running -= 1
+
+    def peek_lane(self) -> str | None:
+        """Get the lane of the next waiting call: lowest virtual time among those that may run."""
+        lanes = [
+            lane
+            for lane, sources in self.queues.items()
+            if sources and self.can_run(lane)
+        ]
+        if not lanes:
+            return None
+        return min(lanes, key=lambda lane: self.passes[lane])
+
+    def next_waiting(self, lane: str) -> threading.Event:
+        """Pop the next waiting call of a lane, sources in turn."""
+        self.virtual_time = self.passes[lane]
+        self.passes[lane] += 1.0 / self.weights[lane]
+        sources = self.queues[lane]
+        source, events = next(iter(sources.items()))
+        event = events.popleft()
+        if events:
+            sources.move_to_end(source)
+        else:
+            del sources[source]
+        return event
+
+    def n_waiting(self, lane: str = None) -> int:
+        """Number of calls waiting, in a lane or in all lanes."""
+        lanes = [lane] if lane else list(self.queues)
+        return sum(
+            len(events) for lane in lanes for events in self.queues[lane].values()
+        )
+
+    def summary(self) -> dict:
+        """
+        Return queue length and wait time percentiles of each lane as a dictionary
+        """
+        with self.lock:
+            lanes = {}
+            for lane, waits in self.waits.items():
+                waits = sorted(waits)
+                lanes[lane] = {
+                    "weight": self.weights[lane],
+                    "running": self.running_lanes[lane],
+                    "calls": self.n_calls[lane],
+                    "waiting": self.n_waiting(lane),
+                    "wait_p50_ms": (
+                        round(waits[len(waits) // 2] * 1000, 1) if waits else None
+                    ),
+                    "wait_p99_ms": (
+                        round(waits[int(len(waits) * 0.99)] * 1000, 1)
+                        if waits
+                        else None
+                    ),
+                }
+            return {
+                "concurrency": self.concurrency,
+                "reserved_interactive": self.reserved,
+                "running": self.running,
+                "lanes": lanes,
+            }
+
+
+inference_scheduler = InferenceScheduler(
+    concurrency=int(os.getenv("INFERENCE_CONCURRENCY", 2)),
+    reserved=int(os.getenv("INFERENCE_RESERVED_INTERACTIVE", 1)),
+)
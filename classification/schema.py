@@ -2,11 +2,23 @@ from typing import List
 from fastapi import HTTPException
 from utils.logger import raise_and_log
 from utils.espocrm import EspoAPI, GetParentID
+from utils.kobo import get_kobo_asset
 from utils.sources import Source
-from utils.translate import translate_text
-from utils.cosmos import cosmos_container_client, cosmos_source_id
-from azure.cosmos.exceptions import CosmosResourceExistsError
-import requests
+from utils.translate import translate_texts
+from utils.cosmos import cosmos_source_id
+from utils.schema_store import get_schema_store, SchemaNotFoundError
+from utils.cache import make_cache
+from classification.compiled import CompiledSchema
+from classification.models import model_pool
+import hashlib
+import os
+
+# how long a schema checked against its source is considered up-to-date, in seconds
+SCHEMA_PROBE_TTL = float(os.getenv("SCHEMA_PROBE_TTL", 60))
+# schemas by version, shared by instances if CACHE_BACKEND is redis
+schema_cache = make_cache(
+    "schema", max_size=int(os.getenv("SCHEMA_CACHE_SIZE", 256)), ttl=24 * 3600
+)
 
 
 class ClassificationSchemaRecord:
@@ -56,6 +68,41 @@ class ClassificationSchema:
             set([record.level for record in self.data])
         )  # number of levels in the schema
         self.version_id = ""  # version ID of the schema
+        self.compiled = None  # data derived from the schema, see CompiledSchema
+        self.translated = False  # whether labels were translated to English
+        # classifier requested with the headers, for this request only
+        self.classifier_provider = source_settings.get("classifier-provider")
+        self.classifier_model = source_settings.get("classifier-model")
+        # classifier saved with the schema by /create-classification-schema,
+        # None to use CLASSIFIER_PROVIDER and CLASSIFIER_MODEL
+        self.saved_provider = None
+        self.saved_model = None
+        self.check_model()
+
+    def check_model(self):
+        """
+        Check that the classifier model is allowed, raise 400 otherwise;
+        any HuggingFace model would otherwise be downloaded and loaded on request
+        """
+        model = self.classifier_model or self.saved_model
+        if (
+            model
+            and self.get_provider() == "HuggingFace"
+            and not model_pool.is_allowed(model)
+        ):
+            raise_and_log(
+                status_code=400,
+                detail=f"Classifier model {model} is not allowed.",
+                extra_logs=self.get_extra_logs(),
+            )
+
+    def save_classifier(self):
+        """
+        Save the classifier requested with the headers with the schema, as the
+        classifier of later requests without classifier headers
+        """
+        self.saved_provider = self.classifier_provider
+        self.saved_model = self.classifier_model
 
     def get_extra_logs(self) -> dict:
         """
@@ -66,15 +113,41 @@ class ClassificationSchema:
             "source-origin": self.settings["source-origin"],
         }
 
+    def get_provider(self) -> str:
+        """
+        Get the classifier provider of the schema
+        """
+        return (
+            self.classifier_provider
+            or self.saved_provider
+            or os.getenv("CLASSIFIER_PROVIDER")
+        )
+
+    def get_model(self) -> str:
+        """
+        Get the classifier model of the schema
+        """
+        return (
+            self.classifier_model or self.saved_model or os.getenv("CLASSIFIER_MODEL")
+        )
+
+    def get_compiled(self) -> CompiledSchema:
+        """
+        Get data derived from the schema, compile it if missing or outdated
+        """
+        if self.compiled is None or self.compiled.version_id != self.version_id:
+            self.compiled = CompiledSchema.from_records(self.data, self.version_id)
+        return self.compiled
+
     def get_class_id(self, label_en: str) -> str | None:
         """
         Get class id from label_en
         """
         if not label_en:
             return None
-        for record in self.data:
-            if record.label_en == label_en:
-                return record.id
+        compiled = self.get_compiled()
+        if label_en in compiled.index_en:
+            return compiled.ids[compiled.index_en[label_en]]
         raise_and_log(
             status_code=500,
             detail=f"Label {label_en} not found in classification schema",
@@ -87,9 +160,9 @@ class ClassificationSchema:
         """
         if not label_en:
             return None
-        for record in self.data:
-            if record.label_en == label_en:
-                return record.label
+        compiled = self.get_compiled()
+        if label_en in compiled.index_en:
+            return compiled.labels[compiled.index_en[label_en]]
         raise_and_log(
             status_code=500,
             detail=f"Label {label_en} not found in classification schema",
@@ -100,15 +173,7 @@ class ClassificationSchema:
         """
         Get class labels in English for a given level and parent name
         """
-        labels = []
-        for record in self.data:
-            if parent is None:
-                if record.level == level:
-                    labels.append(record.label_en)
-            else:
-                if record.level == level and record.parent == parent:
-                    labels.append(record.label_en)
-        return labels
+        return list(self.get_compiled().children.get((level, parent), []))
 
     def is_up_to_date(self) -> bool:
         """
@@ -116,11 +181,9 @@ class ClassificationSchema:
         """
         is_version_id_up_to_date = True
         if self.source == Source.KOBO:
-            headers = {
-                "Authorization": f"Token {self.settings['source-authorization']}"
-            }
-            URL = f"https://kobo.ifrc.org/api/v2/assets/{self.settings['source-origin']}/?format=json"
-            form = requests.get(URL, headers=headers).json()
+            form = get_kobo_asset(
+                self.settings["source-origin"], self.settings["source-authorization"]
+            )
             if "content" not in form.keys():
                 raise_and_log(
                     status_code=404,
@@ -155,9 +218,10 @@ class ClassificationSchema:
             )
         return is_version_id_up_to_date
 
-    def load_from_source(self):
+    def load_from_source(self, previous: List[ClassificationSchemaRecord] = None):
         """
-        Load classification schema from source
+        Load classification schema from source.
+        Labels of records in `previous` that did not change are not translated again.
         """
         cs_records = []
         translate = self.settings.get("translate", False)
@@ -174,9 +238,6 @@ class ClassificationSchema:
                     ClassificationSchemaRecord(
                         id=level1_record["id"],
                         label=level1_record["name"],
-                        label_en=(
-                            translate_text(level1_record["name"]) if translate else None
-                        ),
                         level=1,
                     )
                 )
@@ -189,11 +250,6 @@ class ClassificationSchema:
                         ClassificationSchemaRecord(
                             id=level2_record["id"],
                             label=level2_record["name"],
-                            label_en=(
-                                translate_text(level2_record["name"])
-                                if translate
-                                else None
-                            ),
                             level=2,
                             parent=GetParentID(
                                 self.settings["source-level1"], level2_record
@@ -209,11 +265,6 @@ class ClassificationSchema:
                         ClassificationSchemaRecord(
                             id=level3_record["id"],
                             label=level3_record["name"],
-                            label_en=(
-                                translate_text(level3_record["name"])
-                                if translate
-                                else None
-                            ),
                             level=3,
                             parent=GetParentID(
                                 self.settings["source-level2"], level3_record
@@ -227,11 +278,9 @@ class ClassificationSchema:
             )  # use as version id the latest modifiedAt
 
         elif self.source == Source.KOBO:
-            headers = {
-                "Authorization": f"Token {self.settings['source-authorization']}"
-            }
-            URL = f"https://kobo.ifrc.org/api/v2/assets/{self.settings['source-origin']}/?format=json"
-            form = requests.get(URL, headers=headers).json()
+            form = get_kobo_asset(
+                self.settings["source-origin"], self.settings["source-authorization"]
+            )
             if "content" not in form.keys():
                 raise_and_log(
                     status_code=404,
@@ -287,11 +336,6 @@ class ClassificationSchema:
                         ClassificationSchemaRecord(
                             id=choice["name"],
                             label=choice["label"][0],
-                            label_en=(
-                                translate_text(choice["label"][0])
-                                if translate
-                                else None
-                            ),
                             level=1,
                         )
                     )
@@ -300,11 +344,6 @@ class ClassificationSchema:
                         ClassificationSchemaRecord(
                             id=choice["name"],
                             label=choice["label"][0],
-                            label_en=(
-                                translate_text(choice["label"][0])
-                                if translate
-                                else None
-                            ),
                             level=2,
                             parent=choice[conditional_column2],
                         )
@@ -314,11 +353,6 @@ class ClassificationSchema:
                         ClassificationSchemaRecord(
                             id=choice["name"],
                             label=choice["label"][0],
-                            label_en=(
-                                translate_text(choice["label"][0])
-                                if translate
-                                else None
-                            ),
                             level=3,
                             parent=choice[conditional_column3],
                         )
@@ -331,6 +365,25 @@ class ClassificationSchema:
             )
         self.n_levels = len(set([record.level for record in cs_records]))
 
+        # translate all new or changed labels at once
+        if translate:
+            known = {
+                (record.level, record.id, record.label): record.label_en
+                for record in previous or []
+            }
+            to_translate = [
+                record
+                for record in cs_records
+                if (record.level, record.id, record.label) not in known
+            ]
+            labels_en = translate_texts([record.label for record in to_translate])
+            for record, label_en in zip(to_translate, labels_en):
+                record.label_en = label_en
+            for record in cs_records:
+                if (record.level, record.id, record.label) in known:
+                    record.label_en = known[(record.level, record.id, record.label)]
+        self.translated = bool(translate)
+
         # Perform sanity checks for each level in the classification schema
         for lvl in range(1, self.n_levels + 1):
             # ensure that all records have unique IDs
@@ -359,42 +412,147 @@ class ClassificationSchema:
                     extra_logs=self.get_extra_logs(),
                 )
         self.data = cs_records
+        self.compiled = None
 
-    def save_to_cosmos(self):
+    def refresh_from_source(self) -> int:
         """
-        Save classification schema to CosmosDB
+        Reload an outdated classification schema from source, re-using the translations
+        of records that did not change.
+        Return the number of new or changed records.
         """
-        schema = {
+        translate = bool(self.settings.get("translate", False))
+        previous_data = self.data if self.translated == translate else []
+        previous_keys = {
+            (record.level, record.id, record.label) for record in self.data
+        }
+        self.load_from_source(previous=previous_data)
+        return len(
+            [
+                record
+                for record in self.data
+                if (record.level, record.id, record.label) not in previous_keys
+            ]
+        )
+
+    def to_document(self) -> dict:
+        """
+        Get the classification schema as a document, as saved to CosmosDB
+        """
+        return {
             "id": cosmos_source_id(self.source, self.settings["source-origin"]),
             "source": self.source.value,
             "n_levels": self.n_levels,
             "data": [vars(record) for record in self.data],
             "version_id": self.version_id,
+            "classifier_provider": self.saved_provider,
+            "classifier_model": self.saved_model,
+            "translated": self.translated,
         }
-        try:
-            cosmos_container_client.create_item(body=schema)
-        except CosmosResourceExistsError:
-            cosmos_container_client.replace_item(item=str(schema["id"]), body=schema)
 
-    def load_from_cosmos(self):
+    def load_from_document(self, schema: dict):
         """
-        Load classification schema from CosmosDB
+        Load classification schema from a document, as saved to CosmosDB
         """
-        source_id = cosmos_source_id(self.source, self.settings["source-origin"])
-        schema = cosmos_container_client.read_item(
-            item=source_id, partition_key=self.source.value
-        )
         self.source = Source(schema["source"])
         self.n_levels = schema["n_levels"]
         self.data = [ClassificationSchemaRecord(**record) for record in schema["data"]]
         self.version_id = schema["version_id"]
+        # classifier saved with the schema, headers take precedence (see get_model)
+        self.saved_provider = schema.get("classifier_provider")
+        self.saved_model = schema.get("classifier_model")
+        # models may have been removed from CLASSIFIER_MODELS since the schema was saved
+        self.check_model()
+        self.translated = schema.get("translated", False)
+        self.compiled = None
+
+    def save_to_cosmos(self):
+        """
+        Save classification schema to CosmosDB
+        """
+        get_schema_store().upsert(self.to_document())
+
+    def load_from_cosmos(self):
+        """
+        Load classification schema from CosmosDB.
+        Raises SchemaNotFoundError if the schema is not in CosmosDB.
+        """
+        source_id = cosmos_source_id(self.source, self.settings["source-origin"])
+        schema = get_schema_store().read(id=source_id, partition_key=self.source.value)
+        self.load_from_document(schema)
+
+    def get_probe_key(self) -> str:
+        """
+        Get the cache key of the schema version last seen at source.
+        Keyed by authorization too, so that a token is never checked by another one.
+        """
+        authorization = hashlib.sha256(
+            self.settings.get("source-authorization", "").encode()
+        ).hexdigest()[:16]
+        source_id = cosmos_source_id(self.source, self.settings["source-origin"])
+        return f"version:{self.source.value}:{source_id}:{authorization}"
+
+    def get_cache_key(self, version_id: str) -> str:
+        """
+        Get the cache key of a version of the schema, as requested: with or without
+        classifier-provider and classifier-model, with or without translated labels
+        """
+        source_id = cosmos_source_id(self.source, self.settings["source-origin"])
+        provider = self.settings.get("classifier-provider") or "default"
+        model = self.settings.get("classifier-model") or "default"
+        translate = bool(self.settings.get("translate", False))
+        return (
+            f"schema:{self.source.value}:{source_id}:{provider}:{model}:"
+            f"{translate}:{version_id}"
+        )
+
+    def load_from_cache(self) -> bool:
+        """
+        Load classification schema from cache, if its version was checked against the
+        source less than SCHEMA_PROBE_TTL seconds ago. Return False if not cached.
+        """
+        version_id = schema_cache.get(self.get_probe_key())
+        if version_id is None:
+            return False
+        return self.load_version_from_cache(version_id)
+
+    def load_latest_from_cache(self) -> bool:
+        """
+        Load the last cached version of the classification schema, which still has
+        to be checked against the source. Return False if not cached.
+        """
+        version_id = schema_cache.get(self.get_cache_key("latest"))
+        if version_id is None:
+            return False
+        return self.load_version_from_cache(version_id)
+
+    def load_version_from_cache(self, version_id: str) -> bool:
+        """Load a version of the classification schema from cache, False if not cached."""
+        cached = schema_cache.get(self.get_cache_key(version_id))
+        if cached is None:
+            return False
+        self.load_from_document(cached["schema"])
+        return True
+
+    def save_to_cache(self, checked: bool = True):
+        """
+        Cache classification schema as the latest version, and, if it was `checked`
+        against the source, record that its version is the one at source.
+        Older versions are never read again and expire.
+        """
+        schema_cache.set(
+            self.get_cache_key(self.version_id), {"schema": self.to_document()}
+        )
+        schema_cache.set(self.get_cache_key("latest"), self.version_id)
+        if checked:
+            schema_cache.set(
+                self.get_probe_key(), self.version_id, ttl=SCHEMA_PROBE_TTL
+            )
 
     def remove_from_cosmos(self):
         """
         Remove classification schema from CosmosDB
         """
         source_id = cosmos_source_id(self.source, self.settings["source-origin"])
-        try:
-            cosmos_container_client.delete_item(body=source_id)
-        except CosmosResourceExistsError:
-            pass
+        schema_cache.delete(self.get_probe_key())
+        schema_cache.delete(self.get_cache_key("latest"))
+        get_schema_store().delete(id=source_id, partition_key=self.source.value)
@@ -0,0 +1,575 @@
+from collections import Counter
+from typing import Dict, List
+import base64
+import datetime
+import os
+import re
+import threading
+import time
+import uuid
+import numpy as np
+import orjson
+from classification.schema import ClassificationSchema
+from utils.cosmos import cosmos_source_id
+from utils.espocrm import EspoAPI, link_attribute
+from utils.kobo import clean_kobo_data, iter_kobo_submissions
+from utils.logger import logger
+from utils.schema_store import get_schema_store, SchemaNotFoundError
+from utils.sources import Source
+
+# bump when the layout of the supervised model document changes
+SUPERVISED_MODEL_FORMAT = 2
+# minimum probability of a supervised prediction, below it the text is classified zero-shot
+SUPERVISED_MIN_CONFIDENCE = float(os.getenv("SUPERVISED_MIN_CONFIDENCE", 0.8))
+# terms with the largest weights kept per class, the others are dropped so that
+# the model fits in one CosmosDB document
+SUPERVISED_MAX_TERMS = int(os.getenv("SUPERVISED_MAX_TERMS", 200))
+# largest supervised model document, in bytes (CosmosDB items are limited to 2 MB)
+SUPERVISED_MAX_DOCUMENT_SIZE = 1900 * 1024
+WORD_PATTERN = re.compile(r"\w\w+")
+
+# training jobs of this process, by job id
+training_jobs = {}
+# how long finished jobs are kept for their status, in seconds
+JOB_TTL = float(os.getenv("JOB_TTL", 24 * 3600))
+
+
+def expire_training_jobs():
+    """Forget the training jobs that finished more than JOB_TTL seconds ago."""
+    now = time.monotonic()
+    for job_id, job in list(training_jobs.items()):
+        if job.finished_at is not None and now - job.finished_at > JOB_TTL:
+            training_jobs.pop(job_id, None)
+
+
+def encode_array(array: np.ndarray) -> dict:
+    """Encode a NumPy array as base64, with its dtype and shape."""
+    return {
+        "dtype": str(array.dtype),
+        "shape": list(array.shape),
+        "data": base64.b64encode(np.ascontiguousarray(array).tobytes()).decode("ascii"),
+    }
+
+
+def decode_array(encoded: dict) -> np.ndarray:
+    """Decode a NumPy array encoded with encode_array."""
+    return np.frombuffer(
+        base64.b64decode(encoded["data"]), dtype=encoded["dtype"]
+    ).reshape(encoded["shape"])
+
+
+def top_terms(coef: np.ndarray, max_terms: int) -> tuple:
+    """
+    Get the positions and weights of the terms with the largest absolute weights
+    of each class, as two (classes x max_terms) arrays
+    """
+    k = min(max_terms, coef.shape[1])
+    if k == 0:
+        return np.zeros((coef.shape[0], 0), dtype=np.int32), coef[:, :0]
+    positions = np.argpartition(-np.abs(coef), k - 1, axis=1)[:, :k]
+    return positions.astype(np.int32), np.take_along_axis(coef, positions, axis=1)
+
+
+def sparse_weights(coef: np.ndarray, max_terms: int) -> np.ndarray:
+    """
+    Keep only the `max_terms` largest weights of each class, rounded to float16
+    as they are stored
+    """
+    positions, weights = top_terms(coef, max_terms)
+    pruned = np.zeros_like(coef, dtype=np.float32)
+    np.put_along_axis(
+        pruned, positions, weights.astype(np.float16).astype(np.float32), axis=1
+    )
+    return pruned
+
+
+def dense_weights(positions: np.ndarray, weights: np.ndarray, n_terms: int):
+    """Get the (classes x terms) weights from the positions and weights of top_terms."""
+    coef = np.zeros((positions.shape[0], n_terms), dtype=np.float32)
+    np.put_along_axis(coef, positions.astype(np.int64), weights, axis=1)
+    return coef
+
+
+def supervised_model_id(schema_id: str) -> str:
+    """Get the CosmosDB id of the supervised model of a given schema."""
+    return f"{schema_id}--supervised"
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text in lowercase words and pairs of consecutive words."""
+    words = WORD_PATTERN.findall(str(text).lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class SupervisedModel:
+    """
+    Classifier trained on the labeled records of a schema version:
+    TF-IDF features and one logistic regression per level.
+    Training requires scikit-learn, prediction only NumPy.
+    """
+
+    def __init__(
+        self,
+        version_id: str,
+        vocabulary: List[str],
+        idf: np.ndarray,
+        levels: Dict[int, dict],
+        n_records: int = 0,
+        trained_at: str = None,
+    ):
+        self.version_id = (
+            version_id  # version ID of the schema the model was trained on
+        )
+        self.vocabulary = vocabulary  # terms, in feature order
+        self.index = {term: i for i, term in enumerate(vocabulary)}
+        self.idf = idf  # inverse document frequency of each term (float32)
+        # level -> {"classes": class ids, "coef": (classes x terms), "intercept": (classes),
+        #           "accuracy": accuracy on held-out records}
+        self.levels = levels
+        self.n_records = n_records  # number of labeled records used for training
+        self.trained_at = trained_at
+
+    def features(self, text: str) -> tuple:
+        """Get the TF-IDF features of a text, as (term positions, weights)."""
+        counts = Counter(
+            self.index[token] for token in tokenize(text) if token in self.index
+        )
+        positions = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        weights *= self.idf[positions]
+        norm = np.linalg.norm(weights)
+        return positions, weights / norm if norm else weights
+
+    def predict_proba(self, level: int, positions: np.ndarray, weights: np.ndarray):
+        """Get the probability of each class of a level."""
+        model = self.levels[level]
+        scores = model["coef"][:, positions] @ weights + model["intercept"]
+        scores = np.exp(scores - scores.max())
+        return scores / scores.sum()
+
+    def predict(self, text: str, children) -> List[str]:
+        """
+        Predict the class ids of a text, level by level, stopping at the first level
+        without a model or without a prediction above SUPERVISED_MIN_CONFIDENCE.
+        `children(level, parent_id)` gives the class ids allowed under a parent.
+        """
+        positions, weights = self.features(text)
+        if not len(positions):
+            return []
+        predicted = []
+        for level in sorted(self.levels):
+            if level != len(predicted) + 1:
+                break
+            classes = self.levels[level]["classes"]
+            allowed = set(children(level, predicted[-1] if predicted else None))
+            probabilities = self.predict_proba(level, positions, weights)
+            best = max(
+                (i for i, class_id in enumerate(classes) if class_id in allowed),
+                key=lambda i: probabilities[i],
+                default=None,
+            )
+            if best is None or probabilities[best] < SUPERVISED_MIN_CONFIDENCE:
+                break
+            predicted.append(classes[best])
+        return predicted
+
+    @classmethod
+    def fit(
+        cls,
+        texts: List[str],
+        labels: Dict[int, List[str | None]],
+        version_id: str,
+        max_features: int = 5000,
+        min_df: int = 2,
+        max_terms: int = SUPERVISED_MAX_TERMS,
+    ):
+        """
+        Train on texts and their class ids per level (None where unlabeled),
+        keeping the `max_terms` largest weights of each class
+        """
+        try:
+            from scipy.sparse import csr_matrix
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.model_selection import train_test_split
+        except ImportError:
+            raise RuntimeError(
+                "Package scikit-learn is required to train supervised classifiers."
+            )
+
+        # vocabulary: most frequent terms by document frequency
+        tokens = [tokenize(text) for text in texts]
+        document_frequency = Counter(term for terms in tokens for term in set(terms))
+        vocabulary = [
+            term
+            for term, df in document_frequency.most_common(max_features)
+            if df >= min_df
+        ]
+        index = {term: i for i, term in enumerate(vocabulary)}
+        n_documents = len(texts)
+        idf = np.array(
+            [
+                np.log((1 + n_documents) / (1 + document_frequency[term])) + 1
+                for term in vocabulary
+            ],
+            dtype=np.float32,
+        )
+
+        # TF-IDF matrix, rows normalized to unit length
+        data, indices, indptr = [], [], [0]
+        for terms in tokens:
+            counts = Counter(index[term] for term in terms if term in index)
+            row = (
+                np.array(list(counts.values()), dtype=np.float32)
+                * idf[list(counts.keys())]
+            )
+            norm = np.linalg.norm(row)
+            data.extend(row / norm if norm else row)
+            indices.extend(counts.keys())
+            indptr.append(len(indices))
+        features = csr_matrix(
+            (data, indices, indptr), shape=(n_documents, len(vocabulary))
+        )
+
+        def fit_level(rows: List[int], targets: List[str]) -> tuple:
+            """Fit one level, return its classes and pruned weights."""
+            estimator = LogisticRegression(max_iter=1000)
+            estimator.fit(features[rows], targets)
+            coef = estimator.coef_.astype(np.float32)
+            intercept = estimator.intercept_.astype(np.float32)
+            if len(estimator.classes_) == 2:
+                # binary: sigmoid(z) is the softmax of (-z/2, z/2)
+                coef = np.vstack([-coef / 2, coef / 2])
+                intercept = np.concatenate([-intercept / 2, intercept / 2])
+            classes = [str(class_id) for class_id in estimator.classes_]
+            return classes, sparse_weights(coef, max_terms), intercept
+
+        levels = {}
+        for level, level_labels in labels.items():
+            rows = [i for i, label in enumerate(level_labels) if label]
+            targets = [level_labels[i] for i in rows]
+            if len(set(targets)) < 2:
+                continue
+            # accuracy on held-out records, with pruned weights, then train on all of them
+            accuracy = None
+            if len(rows) >= 20:
+                train_rows, test_rows, train_targets, test_targets = train_test_split(
+                    rows, targets, test_size=0.2, random_state=0
+                )
+                classes, coef, intercept = fit_level(train_rows, train_targets)
+                scores = features[test_rows] @ coef.T + intercept
+                predicted = [classes[i] for i in np.argmax(scores, axis=1)]
+                accuracy = round(
+                    float(np.mean([p == t for p, t in zip(predicted, test_targets)])),
+                    3,
+                )
+            classes, coef, intercept = fit_level(rows, targets)
+            levels[level] = {
+                "classes": classes,
+                "coef": coef,
+                "intercept": intercept,
+                "accuracy": accuracy,
+            }
+
+        return cls(
+            version_id=version_id,
+            vocabulary=vocabulary,
+            idf=idf,
+            levels=levels,
+            n_records=n_documents,
+            trained_at=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        )
+
+    def to_document(self, schema_id: str, source: str) -> dict:
+        """
+        Get the model as a CosmosDB document, stored next to its schema.
+        Weights were pruned when training: only the non-zero ones are stored.
+        """
+        levels = {}
+        for level, model in self.levels.items():
+            n_terms = int(np.count_nonzero(model["coef"], axis=1).max(initial=0))
+            positions, weights = top_terms(model["coef"], n_terms)
+            levels[str(level)] = {
+                "classes": model["classes"],
+                "coef": {
+                    "positions": encode_array(positions),
+                    "weights": encode_array(weights.astype(np.float16)),
+                },
+                "intercept": encode_array(model["intercept"]),
+                "accuracy": model["accuracy"],
+            }
+        return {
+            "id": supervised_model_id(schema_id),
+            "source": source,
+            "type": "supervised-model",
+            "format": SUPERVISED_MODEL_FORMAT,
+            "version_id": self.version_id,
+            "n_records": self.n_records,
+            "trained_at": self.trained_at,
+            "vocabulary": self.vocabulary,
+            "idf": encode_array(self.idf),
+            "levels": levels,
+        }
+
+    @classmethod
+    def from_document(cls, document: dict):
+        """
+        Load the model from a CosmosDB document, None if stored in another format
+        """
+        if document.get("format") != SUPERVISED_MODEL_FORMAT:
+            return None
+        return cls(
+            version_id=document["version_id"],
+            vocabulary=document["vocabulary"],
+            idf=decode_array(document["idf"]),
+            levels={
+                int(level): {
+                    "classes": model["classes"],
+                    "coef": dense_weights(
+                        decode_array(model["coef"]["positions"]),
+                        decode_array(model["coef"]["weights"]),
+                        len(document["vocabulary"]),
+                    ),
+                    "intercept": decode_array(model["intercept"]),
+                    "accuracy": model["accuracy"],
+                }
+                for level, model in document["levels"].items()
+            },
+            n_records=document["n_records"],
+            trained_at=document["trained_at"],
+        )
+
+    def summary(self) -> dict:
+        """
+        Return training data size and held-out accuracy per level as a dictionary
+        """
+        return {
+            "version_id": self.version_id,
+            "trained_at": self.trained_at,
+            "records": self.n_records,
+            "terms": len(self.vocabulary),
+            "levels": {
+                level: {
+                    "classes": len(model["classes"]),
+                    "accuracy": model["accuracy"],
+                }
+                for level, model in self.levels.items()
+            },
+        }
+
+
+class SupervisedRegistry:
+    """
+    Supervised models of the schemas, by schema id. Each model is re-checked in
+    the schema store every `ttl` seconds, and only used for the schema version it
+    was trained on.
+    """
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self.models = {}  # (source, schema id) -> (expiry time, etag, model or None)
+        self.lock = threading.Lock()
+
+    def get(self, schema: ClassificationSchema) -> SupervisedModel | None:
+        """
+        Get the supervised model of a schema version, None if there is none
+        """
+        schema_id = cosmos_source_id(schema.source, schema.settings["source-origin"])
+        key = (schema.source.value, schema_id)
+        with self.lock:
+            entry = self.models.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            etag, model = entry[1:] if entry else (None, None)
+            try:
+                document = get_schema_store().read(
+                    id=supervised_model_id(schema_id), partition_key=schema.source.value
+                )
+                if document.get("_etag") != etag:
+                    etag, model = document.get("_etag"), SupervisedModel.from_document(
+                        document
+                    )
+            except SchemaNotFoundError:
+                etag, model = None, None
+            except Exception as e:
+                logger.warning(f"Could not load supervised model of {schema_id}: {e}")
+            entry = (time.monotonic() + self.ttl, etag, model)
+            with self.lock:
+                self.models[key] = entry
+        model = entry[2]
+        if model is None or model.version_id != schema.version_id:
+            return None
+        return model
+
+    def register(self, schema: ClassificationSchema, model: SupervisedModel):
+        """
+        Save the supervised model of a schema, for all instances
+        """
+        schema_id = cosmos_source_id(schema.source, schema.settings["source-origin"])
+        document = model.to_document(schema_id, schema.source.value)
+        size = len(orjson.dumps(document))
+        if size > SUPERVISED_MAX_DOCUMENT_SIZE:
+            raise ValueError(
+                f"Supervised model is {size / 1024**2:.1f} MB, more than CosmosDB can "
+                f"store ({SUPERVISED_MAX_DOCUMENT_SIZE / 1024**2:.1f} MB); "
+                f"lower SUPERVISED_MAX_TERMS."
+            )
+        document = get_schema_store().upsert(document)
+        with self.lock:
+            self.models[(schema.source.value, schema_id)] = (
+                time.monotonic() + self.ttl,
+                document.get("_etag"),
+                model,
+            )
+
+    def remove(self, schema: ClassificationSchema):
+        """
+        Remove the supervised model of a schema, if any
+        """
+        schema_id = cosmos_source_id(schema.source, schema.settings["source-origin"])
+        get_schema_store().delete(
+            id=supervised_model_id(schema_id), partition_key=schema.source.value
+        )
+        with self.lock:
+            self.models.pop((schema.source.value, schema_id), None)
+
+
+supervised_registry = SupervisedRegistry(ttl=float(os.getenv("SCHEMA_PROBE_TTL", 60)))
+
+
+class TrainingJob:
+    """
+    Training of the supervised model of a schema on the records already
+    classified in the source (Kobo submissions or EspoCRM records)
+    """
+
+    def __init__(
+        self,
+        schema: ClassificationSchema,
+        text_field: str,
+        entity: str = None,
+        only_verified: bool = True,
+        verified_field: str = None,
+        min_records: int = 50,
+    ):
+        if schema.source == Source.ESPOCRM and not entity:
+            raise ValueError("Entity is required to train on EspoCRM records")
+        if schema.source == Source.ESPOCRM and only_verified and not verified_field:
+            raise ValueError(
+                "Verified field is required to train on verified records, "
+                "or set only-verified to false"
+            )
+        self.id = str(uuid.uuid4())
+        self.schema = schema
+        self.text_field = text_field  # field (Kobo question) with the text
+        self.entity = entity  # EspoCRM entity with the classified records
+        # train only on records whose classification was verified: approved
+        # submissions in Kobo, records with verified_field true in EspoCRM
+        self.only_verified = only_verified
+        self.verified_field = verified_field
+        self.min_records = min_records  # minimum number of labeled records to train
+        self.status = "pending"
+        self.detail = ""
+        self.n_records = 0
+        self.model = None
+        self.finished_at = None  # monotonic time the job completed or failed
+        expire_training_jobs()
+        training_jobs[self.id] = self
+
+    def iter_labeled(self):
+        """
+        Iterate over labeled records as (text, [level 1 id, level 2 id, level 3 id])
+        """
+        settings = self.schema.settings
+        fields = [settings.get(f"source-level{level}") for level in [1, 2, 3]]
+        if self.schema.source == Source.KOBO:
+            for submissions in iter_kobo_submissions(
+                settings["source-origin"], settings["source-authorization"]
+            ):
+                for submission in submissions:
+                    if (
+                        self.only_verified
+                        and (submission.get("_validation_status") or {}).get("uid")
+                        != "validation_status_approved"
+                    ):
+                        continue
+                    submission = clean_kobo_data(submission)
+                    yield submission.get(self.text_field.lower()), [
+                        submission.get(field.lower()) if field else None
+                        for field in fields
+                    ]
+        elif self.schema.source == Source.ESPOCRM:
+            attributes = [link_attribute(field) if field else None for field in fields]
+            where = [{"type": "isNotNull", "attribute": attributes[0]}]
+            if self.only_verified:
+                where.append({"type": "isTrue", "attribute": self.verified_field})
+            client = EspoAPI(
+                settings["source-origin"], settings["source-authorization"]
+            )
+            for records in client.iter_records(
+                self.entity,
+                select=["id", self.text_field]
+                + [attribute for attribute in attributes if attribute],
+                where=where,
+            ):
+                for record in records:
+                    yield record.get(self.text_field), [
+                        record.get(attribute) if attribute else None
+                        for attribute in attributes
+                    ]
+
+    def run(self):
+        """
+        Pull labeled records, train the model and register it for the schema version
+        """
+        self.status = "running"
+        try:
+            known = {(record.level, record.id) for record in self.schema.data}
+            texts, labels = [], {1: [], 2: [], 3: []}
+            for text, ids in self.iter_labeled():
+                if not text or not ids[0]:
+                    continue
+                texts.append(str(text))
+                for level, class_id in zip([1, 2, 3], ids):
+                    # classes that are no longer in the schema cannot be predicted
+                    labels[level].append(
+                        class_id if (level, class_id) in known else None
+                    )
+                self.n_records = len(texts)
+            if self.n_records < self.min_records:
+                self.status = "failed"
+                self.detail = (
+                    f"Only {self.n_records} labeled records, "
+                    f"at least {self.min_records} are needed."
+                )
+                return
+            self.model = SupervisedModel.fit(
+                texts, labels, version_id=self.schema.version_id
+            )
+            supervised_registry.register(self.schema, self.model)
+            self.status = "completed"
+            logger.info(
+                f"Trained supervised classifier on {self.n_records} records: "
+                f"{self.model.summary()}",
+                extra=self.schema.get_extra_logs(),
+            )
+        except Exception as e:
+            self.status = "failed"
+            self.detail = str(getattr(e, "detail", e))
+            logger.error(
+                f"Training of supervised classifier failed: {self.detail}",
+                extra=self.schema.get_extra_logs(),
+            )
+        finally:
+            self.finished_at = time.monotonic()
+
+    def summary(self) -> dict:
+        """
+        Return job status and, once trained, the model summary as a dictionary
+        """
+        return {
+            "job_id": self.id,
+            "version_id": self.schema.version_id,
+            "status": self.status,
+            "detail": self.detail,
+            "records": self.n_records,
+            "model": self.model.summary() if self.model else None,
+        }
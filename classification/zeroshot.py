@@ -0,0 +1,250 @@
+from collections import OrderedDict
+from typing import List, Tuple
+import threading
+import numpy as np
+from utils.logger import logger
+
+HYPOTHESIS_TEMPLATE = "This text is about {}"
+
+
+class ZeroShotEngine:
+    """
+    Zero-shot classification with a natural language inference model, without
+    the overhead of the transformers pipeline: hypotheses are tokenized once per
+    set of candidate labels, each premise once, and all premise-hypothesis pairs
+    run in length-sorted, dynamically padded batches.
+    Texts longer than the model input are classified by overlapping windows,
+    whose scores are pooled (max or mean), instead of being truncated.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        hypothesis_template: str = HYPOTHESIS_TEMPLATE,
+        batch_size: int = 32,
+        cache_size: int = 1024,
+        window_overlap: int = 64,
+        max_tokens: int = 2048,
+        pooling: str = "max",
+    ):
+        if pooling not in ("max", "mean"):
+            raise ValueError(f"Unknown pooling '{pooling}', use 'max' or 'mean'.")
+        self.model = model  # sequence classification model (PyTorch)
+        self.tokenizer = tokenizer
+        self.hypothesis_template = hypothesis_template
+        self.batch_size = batch_size  # premise-hypothesis pairs per forward pass
+        self.cache_size = cache_size  # maximum number of cached sets of hypotheses
+        # texts longer than the model input are split into overlapping windows,
+        # only their first `max_tokens` tokens are classified
+        self.window_overlap = window_overlap  # tokens shared by consecutive windows
+        self.max_tokens = max_tokens
+        self.pooling = pooling  # how scores of the windows of a text are combined
+        self.hypotheses = OrderedDict()  # labels -> token ids of their hypotheses
+        self.lock = threading.Lock()
+        self.max_length = min(tokenizer.model_max_length, 512)
+        self.n_special_tokens = tokenizer.num_special_tokens_to_add(pair=True)
+        self.pad_token_id = tokenizer.pad_token_id or 0
+        self.use_token_type_ids = "token_type_ids" in tokenizer.model_input_names
+        self.entailment_id = self.get_entailment_id()
+        self.pretokenized = self.check_pair_encoding()
+
+    def get_entailment_id(self) -> int:
+        """Get the output of the model that means entailment, the last one if not named."""
+        for label, label_id in self.model.config.label2id.items():
+            if label.lower().startswith("entail"):
+                return label_id
+        return -1
+
+    def encode(self, text: str) -> List[int]:
+        """Tokenize text, without special tokens."""
+        return self.tokenizer(text, add_special_tokens=False, verbose=False)[
+            "input_ids"
+        ]
+
+    def build_pair(
+        self, premise: List[int], hypothesis: List[int]
+    ) -> Tuple[List[int], List[int] | None]:
+        """
+        Join a tokenized premise and hypothesis with the special tokens of the
+        model, truncating the premise to fit; return input and token type ids
+        """
+        premise = premise[: self.max_length - self.n_special_tokens - len(hypothesis)]
+        input_ids = self.tokenizer.build_inputs_with_special_tokens(premise, hypothesis)
+        token_type_ids = (
+            self.tokenizer.create_token_type_ids_from_sequences(premise, hypothesis)
+            if self.use_token_type_ids
+            else None
+        )
+        return input_ids, token_type_ids
+
+    def check_pair_encoding(self) -> bool:
+        """
+        Check that pairs built from separately tokenized texts match what the
+        tokenizer gives for the pair; if not, pairs are tokenized as a whole.
+        """
+        premise = "Water is scarce."
+        hypothesis = self.hypothesis_template.format("food")
+        expected = self.tokenizer(premise, hypothesis)
+        try:
+            input_ids, token_type_ids = self.build_pair(
+                self.encode(premise), self.encode(hypothesis)
+            )
+        except (AttributeError, NotImplementedError):
+            input_ids, token_type_ids = None, None
+        if expected["input_ids"] == input_ids and (
+            token_type_ids is None or expected.get("token_type_ids") == token_type_ids
+        ):
+            return True
+        logger.warning(
+            f"Tokenizer {type(self.tokenizer).__name__} does not build pairs from "
+            "pre-tokenized texts, tokenizing each pair."
+        )
+        return False
+
+    def get_hypotheses(self, labels: List[str]) -> List[List[int]]:
+        """Get the tokenized hypotheses of candidate labels, tokenize them on first use."""
+        key = tuple(labels)
+        with self.lock:
+            if key in self.hypotheses:
+                self.hypotheses.move_to_end(key)
+                return self.hypotheses[key]
+        hypotheses = [
+            self.encode(self.hypothesis_template.format(label)) for label in labels
+        ]
+        with self.lock:
+            self.hypotheses[key] = hypotheses
+            while len(self.hypotheses) > self.cache_size:
+                self.hypotheses.popitem(last=False)
+        return hypotheses
+
+    def get_window_starts(self, n_tokens: int, window: int) -> range:
+        """
+        Get the start of each window of a premise of `n_tokens` tokens, windows of
+        `window` tokens overlapping by window_overlap, up to max_tokens
+        """
+        overlap = min(self.window_overlap, window // 2)
+        n_tokens = min(n_tokens, self.max_tokens)
+        return range(0, max(n_tokens - overlap, 1), window - overlap)
+
+    def build_pairs(
+        self, texts: List[str], labels: List[str]
+    ) -> Tuple[List[tuple], List[int]]:
+        """
+        Build all premise-hypothesis pairs, as (input ids, token type ids), one per
+        window of each text and label; return them with the index of the
+        (text, label) each belongs to, in text-major order
+        """
+        if not self.pretokenized:
+            return self.build_pairs_tokenized(texts, labels)
+        hypotheses = self.get_hypotheses(labels)
+        window = self.max_length - self.n_special_tokens - max(map(len, hypotheses))
+        pairs, owners = [], []
+        for i, text in enumerate(texts):
+            premise = self.encode(text)
+            windows = [
+                premise[start : start + window]
+                for start in self.get_window_starts(len(premise), window)
+            ]
+            for j, hypothesis in enumerate(hypotheses):
+                pairs.extend(
+                    self.build_pair(window_ids, hypothesis) for window_ids in windows
+                )
+                owners.extend([i * len(labels) + j] * len(windows))
+        return pairs, owners
+
+    def build_pairs_tokenized(
+        self, texts: List[str], labels: List[str]
+    ) -> Tuple[List[tuple], List[int]]:
+        """
+        Build all premise-hypothesis pairs by tokenizing each pair, windows
+        given by the tokenizer as overflowing tokens
+        """
+        hypotheses = [self.hypothesis_template.format(label) for label in labels]
+        window = (
+            self.max_length
+            - self.n_special_tokens
+            - max(len(self.encode(hypothesis)) for hypothesis in hypotheses)
+        )
+        encoded = self.tokenizer(
+            [text for text in texts for _ in labels],
+            hypotheses * len(texts),
+            truncation="only_first",
+            max_length=self.max_length,
+            stride=min(self.window_overlap, window // 2),
+            return_overflowing_tokens=True,
+        )
+        input_ids = encoded["input_ids"]
+        token_type_ids = encoded.get("token_type_ids", [None] * len(input_ids))
+        owners = encoded.get("overflow_to_sample_mapping", range(len(input_ids)))
+        max_windows = len(self.get_window_starts(self.max_tokens, window))
+        pairs, kept_owners, n_windows = [], [], {}
+        for pair_input_ids, pair_token_type_ids, owner in zip(
+            input_ids, token_type_ids, owners
+        ):
+            n_windows[owner] = n_windows.get(owner, 0) + 1
+            if n_windows[owner] <= max_windows:
+                pairs.append((pair_input_ids, pair_token_type_ids))
+                kept_owners.append(int(owner))
+        return pairs, kept_owners
+
+    def forward(self, pairs: List[tuple]) -> np.ndarray:
+        """Run the model on a batch of pairs padded to the longest, return the entailment logits."""
+        import torch
+
+        length = max(len(input_ids) for input_ids, _ in pairs)
+        input_ids = np.full((len(pairs), length), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(pairs), length), dtype=np.int64)
+        token_type_ids = np.zeros((len(pairs), length), dtype=np.int64)
+        for row, (pair_input_ids, pair_token_type_ids) in enumerate(pairs):
+            input_ids[row, : len(pair_input_ids)] = pair_input_ids
+            attention_mask[row, : len(pair_input_ids)] = 1
+            if pair_token_type_ids is not None:
+                token_type_ids[row, : len(pair_token_type_ids)] = pair_token_type_ids
+        inputs = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(attention_mask),
+        }
+        if self.use_token_type_ids:
+            inputs["token_type_ids"] = torch.from_numpy(token_type_ids)
+        inputs = {name: tensor.to(self.model.device) for name, tensor in inputs.items()}
+        with torch.inference_mode():
+            logits = self.model(**inputs).logits
+        return logits[:, self.entailment_id].float().cpu().numpy()
+
+    def scores(
+        self, texts: List[str], labels: List[str], batch_size: int = None
+    ) -> np.ndarray:
+        """
+        Get the probability of each label for each text, as a (texts x labels) array:
+        softmax over the labels of the entailment logits, pooled over the windows
+        of long texts
+        """
+        batch_size = batch_size or self.batch_size
+        pairs, owners = self.build_pairs(texts, labels)
+        # sort pairs by length, so that each batch is padded as little as possible
+        order = np.argsort([len(input_ids) for input_ids, _ in pairs], kind="stable")
+        entailment = np.empty(len(pairs), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            batch = order[start : start + batch_size]
+            entailment[batch] = self.forward([pairs[i] for i in batch])
+        owners = np.asarray(owners, dtype=np.int64)
+        if self.pooling == "max":
+            pooled = np.full(len(texts) * len(labels), -np.inf, dtype=np.float32)
+            np.maximum.at(pooled, owners, entailment)
+        else:
+            pooled = np.bincount(
+                owners, weights=entailment, minlength=len(texts) * len(labels)
+            ) / np.maximum(np.bincount(owners, minlength=len(texts) * len(labels)), 1)
+        pooled = pooled.reshape(len(texts), len(labels))
+        pooled = np.exp(pooled - pooled.max(axis=1, keepdims=True))
+        return pooled / pooled.sum(axis=1, keepdims=True)
+
+    def predict(
+        self, texts: List[str], labels: List[str], batch_size: int = None
+    ) -> List[str]:
+        """
+        Get the most likely label of each text
+        """
+        scores = self.scores(texts, labels, batch_size)
+        return [labels[i] for i in scores.argmax(axis=1)]
@@ -1,4 +1,5 @@
 from __future__ import annotations
+from contextlib import asynccontextmanager
 import uvicorn
 from fastapi import (
     FastAPI,
@@ -6,22 +7,15 @@ from fastapi import (
 from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
-from routes import classify, load
+from routes import classify, load, profiling
+from classification.classifier import warmup_classifier
+from classification.prewarm import prewarm_schemas
+from utils.logger import setup_logging, shutdown_logging
+from utils.capture import request_capture
+from utils.schema_store import get_schema_store
+from utils.language import language_detector
+from utils.startup import startup
 import os
-import logging
-import sys
-
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s : %(levelname)s : %(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-logging.getLogger("azure").setLevel(logging.WARNING)
-logging.getLogger("requests_oauthlib").setLevel(logging.WARNING)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -41,9 +35,28 @@ Built with love by [NLRC 510](https://www.510.global/). See
 
 tags_metadata = [{"name": "classify", "description": "Classify qualitative feedback."}]
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize clients at startup, load the model and prewarm schemas in the background."""
+    with startup.step("logging"):
+        setup_logging()
+    with startup.step("schema-store"):
+        get_schema_store()
+    with startup.step("language-detection"):
+        language_detector.get_model()
+    startup.run_in_background("model-warmup", warmup_classifier)
+    startup.run_in_background("schema-prewarm", prewarm_schemas)
+    startup.mark_started()
+    yield
+    request_capture.close()
+    shutdown_logging()
+
+
 # initialize FastAPI
 app = FastAPI(
     title="qfa-api",
+    lifespan=lifespan,
     description=description,
     version="0.0.1",
     license_info={
@@ -67,9 +80,17 @@ async def docs_redirect():
     return RedirectResponse(url="/docs")
 
 
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """Report whether startup (including model warmup) completed without errors."""
+    summary = startup.summary()
+    return JSONResponse(status_code=200 if summary["ready"] else 503, content=summary)
+
+
 # Include routes
 app.include_router(classify.router)
 app.include_router(load.router)
+app.include_router(profiling.router)
 
 
 if __name__ == "__main__":
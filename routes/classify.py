@@ -1,20 +1,44 @@
 from __future__ import annotations
 
+import csv
+import io
+import itertools
 import os
-from typing import Annotated
-from fastapi import APIRouter, Header, Request, Depends
+import orjson
+import pandas as pd
+from tempfile import SpooledTemporaryFile
+from typing import Annotated, Iterator, List
+import requests
+from fastapi import APIRouter, BackgroundTasks, Header, HTTPException, Request, Depends
+from pydantic import Field
 from fastapi.security import APIKeyHeader
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from classification.schema import ClassificationSchema
 from utils.sources import Source
-from utils.logger import logger, raise_and_log
+from utils.logger import logger, log_fields, log_request, raise_and_log
 from utils.kobo import clean_kobo_data
 from routes.load import CreateClassificationSchemaHeaders
 from classification.classifier import Classifier
-from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from classification.models import model_pool
+from classification.scheduler import inference_scheduler
+from classification.reclassify import ReclassificationJob, jobs
+from classification.supervised import TrainingJob, training_jobs
+from utils.schema_store import get_schema_store, SchemaNotFoundError
+from utils.idempotency import IdempotencyCache
+from utils.language import language_detector
+from utils.translate import translation_service
+from utils.files import iter_table_chunks
+from utils.resilience import breakers, request_budget
+from utils.cache import caches
+from utils.capture import request_capture
+from utils.profiling import profiler
 
 router = APIRouter()
 header_API_key = APIKeyHeader(name="API-KEY")
+idempotency_cache = IdempotencyCache(ttl=float(os.getenv("IDEMPOTENCY_TTL", 600)))
+# uploads larger than this are spooled to disk, in bytes
+UPLOAD_SPOOL_SIZE = int(os.getenv("UPLOAD_SPOOL_SIZE", 10 * 1024 * 1024))
 
 
 def get_source_text(source_text, payload: dict):
@@ -28,69 +52,142 @@ def get_source_text(source_text, payload: dict):
         return payload[source_text]
 
 
-@router.post("/classify-text", tags=["classify"])
-async def classify_text(
-    request: Request,
-    headers: Annotated[CreateClassificationSchemaHeaders, Header()],
-    key: str = Depends(header_API_key),
-):
+def load_classification_schema(
+    source_settings, extra_logs: dict
+) -> ClassificationSchema:
     """
-    Classify text according to classification schema.
+    Load classification schema from cache or CosmosDB, refresh it from source if outdated or missing.
+    Schemas recently checked against the source (by any instance, with a shared cache) are not checked again.
     """
+    schema = ClassificationSchema(source_settings=source_settings)
+    if schema.load_from_cache():
+        log_fields(schema="cache")
+        return schema
 
-    if key != os.getenv("API_KEY"):
-        raise_and_log(status_code=403, detail="Invalid API key.")
-
-    payload = await request.json()
-    extra_logs = {
-        "source-name": request.headers["source-name"].lower(),
-        "source-origin": request.headers["source-origin"],
-    }
-    logger.info(
-        f"Classifying text from {request.headers['source-name']}.", extra=extra_logs
-    )
-
-    # load classification schema
-    schema = ClassificationSchema(source_settings=request.headers)
-
+    checked = True  # whether the schema was checked against the source
     try:
-        schema.load_from_cosmos()
+        # the last version seen (e.g. prewarmed) saves reading CosmosDB,
+        # it is checked against the source all the same
+        cached = schema.load_latest_from_cache()
+        if not cached:
+            schema.load_from_cosmos()
         # check that classification schema is up-to-date
-        if not schema.is_up_to_date():
+        try:
+            is_up_to_date = schema.is_up_to_date()
+        except (HTTPException, requests.RequestException) as e:
+            if isinstance(e, HTTPException) and e.status_code < 500:
+                raise
+            # source is down or slow, better classify with the cached schema than fail
+            logger.warning(
+                f"Could not check if classification schema is up-to-date, using cached schema: {e}",
+                extra=extra_logs,
+            )
+            is_up_to_date, checked = True, False
+        if not is_up_to_date:
             logger.info(
-                "Classification schema is outdated, loading schema from source and saving to CosmosDB.",
+                "Classification schema is outdated, refreshing schema from source and saving to CosmosDB.",
+                extra=extra_logs,
+            )
+            n_changed = schema.refresh_from_source()
+            logger.info(
+                f"Classification schema refreshed, {n_changed} new or changed records.",
                 extra=extra_logs,
             )
-            schema.load_from_source()
             schema.save_to_cosmos()
-    except CosmosResourceNotFoundError:
+        log_fields(
+            schema=(
+                "refreshed"
+                if not is_up_to_date
+                else ("cache-checked" if cached else "cosmos")
+            )
+        )
+    except SchemaNotFoundError:
         logger.info(
             "Classification schema not found in CosmosDB, loading schema from source and saving to CosmosDB.",
             extra=extra_logs,
         )
         schema.load_from_source()
         schema.save_to_cosmos()
+        log_fields(schema="source")
+    if checked:
+        schema.save_to_cache()
+    return schema
+
+
+class ClassifyTextHeaders(CreateClassificationSchemaHeaders):
+    source_text: str | None = Field(
+        default=None,
+        description="Name of the question to be classified (required for Kobo).",
+    )
+    idempotency_key: str | None = Field(
+        default=None,
+        description="Unique key of the request (EspoCRM); retries with the same key "
+        "are not classified again. For Kobo, the submission ID is used.",
+    )
+
+
+def get_idempotency_key(source_settings, payload: dict) -> tuple | None:
+    """
+    Get the key identifying retries of the same request, None if there is none.
+    Requests classifying another field, or into other fields, of the same form
+    (e.g. two REST services) are not retries of each other.
+    """
+    source_name = source_settings["source-name"].lower()
+    fields = tuple(
+        source_settings.get(name)
+        for name in ["source-text", "source-level1", "source-level2", "source-level3"]
+    )
+    if source_name == Source.KOBO.value and "_id" in payload:
+        request_id = str(payload["_id"])
+    elif "idempotency-key" in source_settings:
+        request_id = source_settings["idempotency-key"]
+    else:
+        return None
+    return source_name, source_settings["source-origin"], *fields, request_id
+
+
+def classify_payload(source_settings, payload: dict, extra_logs: dict) -> JSONResponse:
+    """
+    Classify the text in the request payload, save results to Kobo or return them.
+    Logs one summary record of the request; profiled if a profiling session matches it.
+    """
+    with profiler.profile_request(source_settings), request_budget(), log_request(
+        "Classified text", extra_logs
+    ):
+        return classify_payload_within_budget(source_settings, payload, extra_logs)
+
+
+def classify_payload_within_budget(
+    source_settings, payload: dict, extra_logs: dict
+) -> JSONResponse:
+    """Classify the text in the request payload, with all dependency calls bounded by the request budget."""
+
+    # load classification schema
+    schema = load_classification_schema(source_settings, extra_logs)
 
     # initialize classifier
     classifier = Classifier(
         schema=schema,
-        translate=request.headers.get("translate", False),
+        translate=source_settings.get("translate", False),
+        lane="interactive",
     )
 
     # get text to classify
     if schema.source == Source.KOBO:
-        if "source-text" not in request.headers:
+        if "source-text" not in source_settings:
             raise_and_log(
                 status_code=400,
                 detail="Header 'source-text' is required for Kobo, "
                 "specifying the name of the question to be classified.",
                 extra_logs=extra_logs,
             )
-        source_text = request.headers["source-text"]
+        source_text = source_settings["source-text"]
         text = get_source_text(source_text.lower(), clean_kobo_data(payload))
     else:
         text = get_source_text("text", payload)
 
+    request_capture.describe(schema, text)
+
     # classify text
     classification_result = classifier.classify(text=text)
 
@@ -106,13 +203,429 @@ async def classify_text(
     return save_result
 
 
+@router.post("/classify-text", tags=["classify"])
+async def classify_text(
+    request: Request,
+    headers: Annotated[ClassifyTextHeaders, Header()],
+    key: str = Depends(header_API_key),
+):
+    """
+    Classify text according to classification schema.
+    """
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+
+    payload = await request.json()
+    extra_logs = {
+        "source-name": request.headers["source-name"].lower(),
+        "source-origin": request.headers["source-origin"],
+    }
+    # retries of the same request share the same computation and result
+    idempotency_key = get_idempotency_key(request.headers, payload)
+    with request_capture.capture("/classify-text", request.headers, idempotency_key):
+        return await idempotency_cache.run(
+            idempotency_key,
+            classify_payload,
+            request.headers,
+            payload,
+            extra_logs,
+        )
+
+
+class ClassifyFileHeaders(CreateClassificationSchemaHeaders):
+    text_column: str = Field(
+        ...,
+        description="Column with the text to classify.",
+    )
+    id_column: str | None = Field(
+        default=None,
+        description="Column with the ID of each row, returned with the results.",
+    )
+    output_format: str = Field(
+        default="ndjson",
+        description="Format of the results: ndjson or csv.",
+    )
+    batch_size: int = Field(
+        default=64,
+        gt=0,
+        description="Number of rows read and classified at once.",
+    )
+
+
+def classify_rows(
+    classifier: Classifier,
+    chunks: List[pd.DataFrame] | Iterator[pd.DataFrame],
+    text_column: str,
+    id_column: str | None,
+) -> Iterator[List[dict]]:
+    """Classify chunks of rows, yield the results of each chunk."""
+    n_rows = 0
+    for chunk in chunks:
+        records = []
+        texts = []
+        for value, row_id in zip(
+            chunk[text_column],
+            chunk[id_column] if id_column else [None] * len(chunk),
+        ):
+            n_rows += 1
+            record = {"row": n_rows}
+            if id_column:
+                record[id_column] = None if pd.isna(row_id) else str(row_id)
+            records.append(record)
+            texts.append(None if pd.isna(value) else str(value).strip())
+        to_classify = [i for i, text in enumerate(texts) if text]
+        results = classifier.classify_batch([texts[i] for i in to_classify])
+        for i, result in zip(to_classify, results):
+            records[i].update(result.results())
+        for i, text in enumerate(texts):
+            records[i]["error"] = None if text else "Empty text."
+        yield records
+
+
+def stream_results(
+    results: Iterator[List[dict]],
+    output_format: str,
+    fieldnames: List[str],
+    chunks: Iterator[pd.DataFrame],
+    file,
+) -> Iterator[bytes]:
+    """Serialize results as NDJSON or CSV, chunk by chunk; close the uploaded file at the end."""
+    try:
+        if output_format == "csv":
+            buffer = io.StringIO()
+            csv.DictWriter(buffer, fieldnames=fieldnames).writeheader()
+            yield buffer.getvalue().encode("utf-8")
+        for records in results:
+            if output_format == "csv":
+                buffer = io.StringIO()
+                csv.DictWriter(buffer, fieldnames=fieldnames).writerows(records)
+                yield buffer.getvalue().encode("utf-8")
+            else:
+                yield b"".join(orjson.dumps(record) + b"\n" for record in records)
+    finally:
+        chunks.close()
+        file.close()
+
+
+@router.post("/classify-file", tags=["classify"])
+async def classify_file(
+    request: Request,
+    headers: Annotated[ClassifyFileHeaders, Header()],
+    key: str = Depends(header_API_key),
+):
+    """
+    Classify the rows of a CSV or XLSX file, sent as request body with its content type.
+    Results are streamed back as NDJSON (or CSV) as each chunk of rows is classified.
+    """
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+    if headers.output_format not in ["ndjson", "csv"]:
+        raise_and_log(
+            status_code=400, detail="Header 'output-format' must be ndjson or csv."
+        )
+
+    extra_logs = {
+        "source-name": request.headers["source-name"].lower(),
+        "source-origin": request.headers["source-origin"],
+    }
+    logger.info(
+        f"Classifying file from {request.headers['source-name']}.", extra=extra_logs
+    )
+
+    # keep at most UPLOAD_SPOOL_SIZE of the upload in memory, the rest on disk
+    file = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+    async for data in request.stream():
+        file.write(data)
+    file.seek(0)
+
+    chunks = None
+    try:
+        chunks = iter_table_chunks(
+            file, request.headers.get("content-type", ""), headers.batch_size
+        )
+        first_chunk = await run_in_threadpool(next, chunks, None)
+        if first_chunk is None:
+            raise_and_log(
+                status_code=400, detail="File is empty.", extra_logs=extra_logs
+            )
+        for column in [headers.text_column, headers.id_column]:
+            if column and column not in first_chunk.columns:
+                raise_and_log(
+                    status_code=400,
+                    detail=f"Column '{column}' not found in file.",
+                    extra_logs=extra_logs,
+                )
+        schema = await run_in_threadpool(
+            load_classification_schema, request.headers, extra_logs
+        )
+    except Exception:
+        if chunks is not None:
+            chunks.close()
+        file.close()
+        raise
+
+    classifier = Classifier(schema=schema, translate=headers.translate, lane="batch")
+    # columns of the results: row number, ID, classification results, error
+    fieldnames = (
+        ["row"]
+        + ([headers.id_column] if headers.id_column else [])
+        + list(classifier.get_result("", None).results().keys())
+        + ["error"]
+    )
+    results = classify_rows(
+        classifier,
+        itertools.chain([first_chunk], chunks),
+        headers.text_column,
+        headers.id_column,
+    )
+    return StreamingResponse(
+        stream_results(results, headers.output_format, fieldnames, chunks, file),
+        media_type=(
+            "text/csv" if headers.output_format == "csv" else "application/x-ndjson"
+        ),
+    )
+
+
+class ReclassifyHeaders(CreateClassificationSchemaHeaders):
+    source_name: str = Field(
+        "EspoCRM",
+        description="Source of classification schema (only EspoCRM is supported).",
+    )
+    source_entity: str = Field(
+        ...,
+        description="Entity whose records will be classified, e.g. Feedback.",
+    )
+    source_text: str = Field(
+        ...,
+        description="Field with the text to classify, e.g. feedbackText.",
+    )
+    source_version_field: str | None = Field(
+        default=None,
+        description="Field where the version ID of the classification schema is saved.",
+    )
+    only_outdated: bool = Field(
+        default=False,
+        description="Only reclassify records that are unclassified "
+        "or were classified with another version of the classification schema.",
+    )
+    batch_size: int = Field(
+        default=32,
+        gt=0,
+        description="Number of records classified at once.",
+    )
+    concurrency: int = Field(
+        default=8,
+        gt=0,
+        description="Number of records updated in parallel.",
+    )
+    rate_limit: float = Field(
+        default=20.0,
+        gt=0,
+        description="Maximum number of record updates per second.",
+    )
+
+
+@router.post("/reclassify-espocrm", tags=["classify"])
+async def reclassify_espocrm(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    headers: Annotated[ReclassifyHeaders, Header()],
+    key: str = Depends(header_API_key),
+):
+    """
+    Reclassify all (or only outdated) records of an EspoCRM entity in the background.
+    """
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+
+    extra_logs = {
+        "source-name": request.headers["source-name"].lower(),
+        "source-origin": request.headers["source-origin"],
+    }
+    if request.headers["source-name"].lower() != Source.ESPOCRM.value:
+        raise_and_log(
+            status_code=400,
+            detail="Bulk reclassification is only supported for EspoCRM.",
+            extra_logs=extra_logs,
+        )
+
+    # reading the schema (and its supervised model) may call EspoCRM, the translator
+    # and CosmosDB: keep it off the event loop
+    schema = await run_in_threadpool(
+        load_classification_schema, request.headers, extra_logs
+    )
+    job = await run_in_threadpool(
+        ReclassificationJob,
+        schema=schema,
+        entity=headers.source_entity,
+        text_field=headers.source_text,
+        translate=headers.translate,
+        only_outdated=headers.only_outdated,
+        version_field=headers.source_version_field,
+        batch_size=headers.batch_size,
+        concurrency=headers.concurrency,
+        rate_limit=headers.rate_limit,
+    )
+    background_tasks.add_task(job.run)
+
+    return JSONResponse(status_code=202, content=job.summary())
+
+
+@router.get("/reclassify-espocrm/{job_id}", tags=["classify"])
+async def get_reclassification_job(
+    job_id: str,
+    key: str = Depends(header_API_key),
+):
+    """Get status of a bulk reclassification job."""
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+    if job_id not in jobs:
+        raise_and_log(status_code=404, detail=f"Job {job_id} not found.")
+
+    return JSONResponse(status_code=200, content=jobs[job_id].summary())
+
+
+class TrainClassifierHeaders(CreateClassificationSchemaHeaders):
+    source_text: str = Field(
+        ...,
+        description="Field (Kobo question) with the classified text, e.g. feedbackText.",
+    )
+    source_entity: str | None = Field(
+        default=None,
+        description="Entity with the classified records, e.g. Feedback (required for EspoCRM).",
+    )
+    only_verified: bool = Field(
+        default=True,
+        description="Only train on verified classifications: approved submissions (Kobo) "
+        "or records where source-verified-field is true (EspoCRM). Set to false to also "
+        "train on unverified classifications, which were mostly made by the zero-shot model.",
+    )
+    source_verified_field: str | None = Field(
+        default=None,
+        description="Boolean field marking records whose classification was verified (EspoCRM).",
+    )
+    min_records: int = Field(
+        default=50,
+        description="Minimum number of labeled records needed to train.",
+    )
+
+
+@router.post("/train-classifier", tags=["classify"])
+async def train_classifier(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    headers: Annotated[TrainClassifierHeaders, Header()],
+    key: str = Depends(header_API_key),
+):
+    """
+    Train a fast classifier on the records already classified in the source, in the background.
+    Once trained, it is used for the current version of the classification schema; texts it
+    cannot classify confidently are still classified zero-shot.
+    """
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+
+    extra_logs = {
+        "source-name": request.headers["source-name"].lower(),
+        "source-origin": request.headers["source-origin"],
+    }
+    schema = await run_in_threadpool(
+        load_classification_schema, request.headers, extra_logs
+    )
+    try:
+        job = TrainingJob(
+            schema=schema,
+            text_field=headers.source_text,
+            entity=headers.source_entity,
+            only_verified=headers.only_verified,
+            verified_field=headers.source_verified_field,
+            min_records=headers.min_records,
+        )
+    except ValueError as e:
+        raise_and_log(status_code=400, detail=str(e), extra_logs=extra_logs)
+    background_tasks.add_task(job.run)
+
+    return JSONResponse(status_code=202, content=job.summary())
+
+
+@router.get("/train-classifier/{job_id}", tags=["classify"])
+async def get_training_job(
+    job_id: str,
+    key: str = Depends(header_API_key),
+):
+    """Get status of a training job and accuracy of the trained classifier."""
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+    if job_id not in training_jobs:
+        raise_and_log(status_code=404, detail=f"Job {job_id} not found.")
+
+    return JSONResponse(status_code=200, content=training_jobs[job_id].summary())
+
+
 @router.get("/get-classification-model", tags=["classify"])
 async def get_classification_model():
-    """Get classification model."""
+    """Get default classification model and models currently in memory."""
     return JSONResponse(
         status_code=200,
         content={
             "provider": os.getenv("CLASSIFIER_PROVIDER"),
             "model": os.getenv("CLASSIFIER_MODEL"),
+            **model_pool.summary(),
+        },
+    )
+
+
+@router.get("/get-translation-stats", tags=["classify"])
+async def get_translation_stats(key: str = Depends(header_API_key)):
+    """Get translation calls, cache hits and how often translation was skipped."""
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+    return JSONResponse(
+        status_code=200,
+        content={
+            "language_detection": language_detector.summary(),
+            "translation": translation_service.summary(),
         },
     )
+
+
+@router.get("/get-scheduler-stats", tags=["classify"])
+async def get_scheduler_stats(key: str = Depends(header_API_key)):
+    """Get running inference calls, queue lengths and wait times of each lane."""
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+    return JSONResponse(status_code=200, content=inference_scheduler.summary())
+
+
+@router.get("/get-cache-stats", tags=["classify"])
+async def get_cache_stats(key: str = Depends(header_API_key)):
+    """
+    Get size and hit rates of the schema and result caches, and how many reads
+    of the schema store were answered with "not modified".
+    """
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+    content = {name: cache.summary() for name, cache in caches.items()}
+    content["schema_store"] = get_schema_store().summary()
+    return JSONResponse(status_code=200, content=content)
+
+
+@router.get("/get-dependency-status", tags=["classify"])
+async def get_dependency_status(key: str = Depends(header_API_key)):
+    """Get the state of the circuit breaker of each external dependency."""
+
+    if key != os.getenv("API_KEY"):
+        raise_and_log(status_code=403, detail="Invalid API key.")
+    return JSONResponse(
+        status_code=200,
+        content={name: breaker.summary() for name, breaker in breakers.items()},
+    )
@@ -4,6 +4,7 @@ from fastapi.security import APIKeyHeader
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from classification.schema import ClassificationSchema
+from classification.supervised import supervised_registry
 from typing import Annotated
 from utils.logger import logger
 import os
@@ -41,6 +42,15 @@ class CreateClassificationSchemaHeaders(BaseModel):
         default=False,
         description="Translate text to English.",
     )
+    classifier_provider: str | None = Field(
+        default=None,
+        description="Classifier provider of this schema (HuggingFace or OpenAI), "
+        "if different from the default.",
+    )
+    classifier_model: str | None = Field(
+        default=None,
+        description="Classifier model of this schema, if different from the default.",
+    )
 
 
 @router.post("/create-classification-schema", tags=["classify"])
@@ -62,8 +72,10 @@ def create_classification_schema(
         extra=extra_logs,
     )
     cs = ClassificationSchema(source_settings=request.headers)
+    cs.save_classifier()
     cs.load_from_source()
     cs.save_to_cosmos()
+    cs.save_to_cache()
 
     return JSONResponse(status_code=200, content=f"Created classification schema.")
 
@@ -88,5 +100,6 @@ def delete_classification_schema(
 
     cs = ClassificationSchema(source_settings=request.headers)
     cs.remove_from_cosmos()
+    supervised_registry.remove(cs)
 
     return JSONResponse(status_code=200, content=f"Deleted classification schema.")
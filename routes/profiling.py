@@ -0,0 +1,126 @@
+from __future__ import annotations
+from typing import Annotated
+import os
+from fastapi import APIRouter, Depends, Header
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from fastapi.security import APIKeyHeader
+from pydantic import BaseModel, Field
+from utils.logger import logger, raise_and_log
+from utils.profiling import profiler
+
+router = APIRouter()
+header_API_key = APIKeyHeader(name="API-KEY")
+
+
+class StartProfilingHeaders(BaseModel):
+    mode: str = Field(
+        default="sampling",
+        description="sampling (low overhead, stacks for flame graphs) or cprofile "
+        "(every call timed, one request at a time; on Python 3.12+, calls of other "
+        "threads are timed too).",
+    )
+    trigger: str = Field(
+        default="window",
+        description="window to profile all classification requests, header to profile "
+        "only those with header profile-id set to the id of the session.",
+    )
+    duration: float = Field(
+        default=60,
+        description="Seconds during which requests are profiled.",
+    )
+    interval: float = Field(
+        default=5,
+        description="Milliseconds between samples (sampling mode), at least 1.",
+    )
+
+
+def check_admin_key(key: str):
+    """Allow only callers with the admin API key; profiling is disabled if none is set."""
+    admin_key = os.getenv("ADMIN_API_KEY")
+    if not admin_key or key != admin_key:
+        raise_and_log(status_code=403, detail="Invalid admin API key.")
+
+
+def get_session():
+    """Get the current or last profiling session, 404 if there is none."""
+    if profiler.session is None:
+        raise_and_log(status_code=404, detail="No profiling session.")
+    return profiler.session
+
+
+@router.post("/profiling/start", tags=["admin"])
+async def start_profiling(
+    headers: Annotated[StartProfilingHeaders, Header()],
+    key: str = Depends(header_API_key),
+):
+    """
+    Profile classification requests for a time window (admin only).
+    """
+    check_admin_key(key)
+    try:
+        session = profiler.start(
+            mode=headers.mode,
+            trigger=headers.trigger,
+            duration=headers.duration,
+            interval=headers.interval / 1000,
+        )
+    except ValueError as e:
+        raise_and_log(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise_and_log(status_code=409, detail=str(e))
+    logger.warning(
+        f"Profiling session {session.id} started: {session.mode} mode, "
+        f"{session.trigger} trigger, {headers.duration}s."
+    )
+    return JSONResponse(status_code=200, content=session.summary())
+
+
+@router.post("/profiling/stop", tags=["admin"])
+async def stop_profiling(key: str = Depends(header_API_key)):
+    """Stop the profiling session before the end of its window (admin only)."""
+    check_admin_key(key)
+    session = get_session()
+    session.stop()
+    return JSONResponse(status_code=200, content=session.summary())
+
+
+@router.get("/profiling/report", tags=["admin"])
+async def get_profiling_report(key: str = Depends(header_API_key)):
+    """Get the functions taking the most time in the profiled requests (admin only)."""
+    check_admin_key(key)
+    return JSONResponse(status_code=200, content=get_session().summary())
+
+
+@router.get("/profiling/report/folded", tags=["admin"])
+async def get_profiling_folded(key: str = Depends(header_API_key)):
+    """
+    Get the sampled stacks in folded format, for flamegraph.pl, speedscope or inferno (admin only).
+    """
+    check_admin_key(key)
+    session = get_session()
+    if session.mode != "sampling":
+        raise_and_log(
+            status_code=400,
+            detail="Folded stacks are recorded in sampling mode, use /profiling/report/pstats.",
+        )
+    return PlainTextResponse(status_code=200, content=session.folded())
+
+
+@router.get("/profiling/report/pstats", tags=["admin"])
+async def get_profiling_pstats(key: str = Depends(header_API_key)):
+    """
+    Get the cProfile statistics in pstats format, for snakeviz or flameprof (admin only).
+    """
+    check_admin_key(key)
+    session = get_session()
+    if session.mode != "cprofile":
+        raise_and_log(
+            status_code=400,
+            detail="Call statistics are recorded in cprofile mode, use /profiling/report/folded.",
+        )
+    return Response(
+        status_code=200,
+        content=session.dump_stats(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{session.id}.prof"'},
+    )
@@ -0,0 +1,278 @@
+from collections import OrderedDict
+from typing import Any, Dict, List
+import os
+import threading
+import time
+import orjson
+from utils.logger import logger
+from utils.resilience import DEPENDENCY_TIMEOUTS, get_breaker
+
+# how long entries of the shared cache are kept in memory, in seconds,
+# so that changes made by other instances are picked up
+CACHE_NEAR_TTL = float(os.getenv("CACHE_NEAR_TTL", 30))
+
+
+class LRUCache:
+    """
+    In-process cache of JSON-serializable values, least recently used evicted first
+    """
+
+    def __init__(self, name: str, max_size: int = 10000, ttl: float = None):
+        self.name = name
+        self.max_size = max_size  # maximum number of entries
+        self.ttl = ttl  # default time to live of entries, in seconds, None to keep them
+        self.entries = OrderedDict()  # key -> (expiry time or None, serialized value)
+        self.lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, key: str) -> Any | None:
+        """Get a value, None if missing or expired."""
+        return self.get_many([key])[key]
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any | None]:
+        """Get many values at once, None for those missing or expired."""
+        now = time.monotonic()
+        values = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and (entry[0] is None or entry[0] > now):
+                    self.entries.move_to_end(key)
+                    self.n_hits += 1
+                    values[key] = entry[1]
+                else:
+                    self.entries.pop(key, None)
+                    self.n_misses += 1
+                    values[key] = None
+        return {
+            key: orjson.loads(value) if value is not None else None
+            for key, value in values.items()
+        }
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        """Cache a value, for `ttl` seconds if given."""
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items: Dict[str, Any], ttl: float = None):
+        """Cache many values at once, for `ttl` seconds if given."""
+        ttl = ttl or self.ttl
+        expiry = time.monotonic() + ttl if ttl else None
+        serialized = {key: orjson.dumps(value) for key, value in items.items()}
+        with self.lock:
+            for key, value in serialized.items():
+                self.entries[key] = (expiry, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str):
+        """Remove a value, if cached."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def summary(self) -> dict:
+        """
+        Return size and hit rate of the cache as a dictionary
+        """
+        with self.lock:
+            n_lookups = self.n_hits + self.n_misses
+            return {
+                "backend": "memory",
+                "size": len(self.entries),
+                "hits": self.n_hits,
+                "misses": self.n_misses,
+                "hit_ratio": round(self.n_hits / n_lookups, 3) if n_lookups else 0.0,
+            }
+
+
+redis_client_ = None
+redis_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Get the Redis client of CACHE_REDIS_URL, connect on first use; None if not available."""
+    global redis_client_
+    if redis_client_ is None:
+        with redis_lock:
+            if redis_client_ is None:
+                try:
+                    import redis
+                except ImportError:
+                    logger.warning(
+                        "Package redis is not installed, using in-process cache only."
+                    )
+                    redis_client_ = False
+                    return None
+                redis_client_ = redis.Redis.from_url(
+                    os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"),
+                    socket_timeout=DEPENDENCY_TIMEOUTS["cache"],
+                    socket_connect_timeout=DEPENDENCY_TIMEOUTS["cache"],
+                )
+    return redis_client_ or None
+
+
+class RedisCache:
+    """
+    Cache of JSON-serializable values shared by all instances, in Redis
+    (or any server speaking the Redis protocol).
+    The cache is an optimization: if the server is unavailable, lookups miss
+    and writes are dropped, requests do not fail.
+    """
+
+    def __init__(self, name: str, ttl: float = None):
+        self.name = name
+        self.ttl = ttl  # default time to live of entries, in seconds, None to keep them
+        self.lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_errors = 0
+
+    def key(self, key: str) -> str:
+        """Prefix keys with the cache name."""
+        return f"qfa:{self.name}:{key}"
+
+    def call(self, method: str, *args):
+        """Call a method of the Redis client through the circuit breaker, None on failure."""
+        client = get_redis_client()
+        if client is None:
+            return None
+        try:
+            return get_breaker("cache").call(getattr(client, method), *args)
+        except Exception as e:
+            with self.lock:
+                self.n_errors += 1
+            logger.warning(f"Shared cache {self.name} unavailable: {e}")
+            return None
+
+    def get(self, key: str) -> Any | None:
+        """Get a value, None if missing."""
+        return self.get_many([key])[key]
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any | None]:
+        """Get many values in one round trip, None for those missing."""
+        if not keys:
+            return {}
+        values = self.call("mget", [self.key(key) for key in keys]) or [None] * len(
+            keys
+        )
+        n_hits = sum(value is not None for value in values)
+        with self.lock:
+            self.n_hits += n_hits
+            self.n_misses += len(keys) - n_hits
+        return {
+            key: orjson.loads(value) if value is not None else None
+            for key, value in zip(keys, values)
+        }
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        """Cache a value, for `ttl` seconds if given."""
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items: Dict[str, Any], ttl: float = None):
+        """Cache many values in one round trip, for `ttl` seconds if given."""
+        client = get_redis_client()
+        if client is None or not items:
+            return
+        ttl = ttl or self.ttl
+        pipeline = client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(
+                self.key(key), orjson.dumps(value), ex=int(ttl) if ttl else None
+            )
+        try:
+            get_breaker("cache").call(pipeline.execute)
+        except Exception as e:
+            with self.lock:
+                self.n_errors += 1
+            logger.warning(f"Shared cache {self.name} unavailable: {e}")
+
+    def delete(self, key: str):
+        """Remove a value, if cached."""
+        self.call("delete", self.key(key))
+
+    def summary(self) -> dict:
+        """
+        Return hit rate and errors of the cache as a dictionary
+        """
+        with self.lock:
+            n_lookups = self.n_hits + self.n_misses
+            return {
+                "backend": "redis",
+                "hits": self.n_hits,
+                "misses": self.n_misses,
+                "errors": self.n_errors,
+                "hit_ratio": round(self.n_hits / n_lookups, 3) if n_lookups else 0.0,
+            }
+
+
+class TieredCache:
+    """
+    Two-tier cache: a small in-process (near) cache in front of a shared (far) one.
+    Near entries expire after CACHE_NEAR_TTL, so that deletions by other
+    instances are picked up.
+    """
+
+    def __init__(self, near: LRUCache, far: RedisCache):
+        self.near = near
+        self.far = far
+
+    def get(self, key: str) -> Any | None:
+        """Get a value from the near cache, else from the far one."""
+        return self.get_many([key])[key]
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any | None]:
+        """Get many values, looking up in the far cache only those missing in the near one."""
+        values = self.near.get_many(keys)
+        missing = [key for key, value in values.items() if value is None]
+        if missing:
+            found = {
+                key: value
+                for key, value in self.far.get_many(missing).items()
+                if value is not None
+            }
+            self.near.set_many(found, ttl=CACHE_NEAR_TTL)
+            values.update(found)
+        return values
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        """Cache a value in both tiers."""
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items: Dict[str, Any], ttl: float = None):
+        """Cache many values in both tiers."""
+        self.near.set_many(items, ttl=min(ttl or CACHE_NEAR_TTL, CACHE_NEAR_TTL))
+        self.far.set_many(items, ttl)
+
+    def delete(self, key: str):
+        """Remove a value from both tiers."""
+        self.near.delete(key)
+        self.far.delete(key)
+
+    def summary(self) -> dict:
+        """
+        Return hit rates of both tiers as a dictionary
+        """
+        return {"near": self.near.summary(), "far": self.far.summary()}
+
+
+caches = {}  # caches by name
+
+
+def make_cache(name: str, max_size: int = 10000, ttl: float = None):
+    """
+    Create a cache: in-process if CACHE_BACKEND is "memory" (default),
+    in-process in front of Redis at CACHE_REDIS_URL if it is "redis".
+    """
+    backend = os.getenv("CACHE_BACKEND", "memory").lower()
+    if backend == "memory":
+        cache = LRUCache(name, max_size=max_size, ttl=ttl)
+    elif backend == "redis":
+        cache = TieredCache(
+            LRUCache(name, max_size=max_size, ttl=CACHE_NEAR_TTL),
+            RedisCache(name, ttl=ttl),
+        )
+    else:
+        raise ValueError(f"Unknown CACHE_BACKEND '{backend}', use 'memory' or 'redis'.")
+    caches[name] = cache
+    return cache
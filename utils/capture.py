@@ -0,0 +1,195 @@
+from contextlib import contextmanager
+import contextvars
+import hashlib
+import os
+import queue
+import random
+import threading
+import time
+import orjson
+from utils.language import language_detector
+from utils.logger import logger
+
+# headers describing how a request is classified, recorded as they are
+RECORDED_HEADERS = (
+    "source-name",
+    "source-text",
+    "source-level1",
+    "source-level2",
+    "source-level3",
+    "translate",
+    "classifier-provider",
+    "classifier-model",
+)
+
+captured_request = contextvars.ContextVar("captured_request", default=None)
+
+
+def anonymize(value: str) -> str:
+    """Replace an identifier with a short hash, the same for the same value."""
+    return hashlib.sha256(str(value).encode()).hexdigest()[:16]
+
+
+class RequestCapture:
+    """
+    Opt-in capture of the shape of classification requests, for replaying
+    production-like traffic (see utils/replay.py): arrival time, form, schema
+    version and size, text length and language, and the headers that are not
+    secrets. Texts, tokens and identifiers are never recorded.
+    Requests are sampled at `rate` and appended as JSON lines to `path`
+    by a background thread, which also detects the language of the texts;
+    when the queue is full, records are dropped.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        rate: float = 1.0,
+        timing: bool = False,
+        max_queue_size: int = 10000,
+    ):
+        self.path = path  # JSON lines file, capture disabled if None
+        self.rate = rate  # fraction of requests captured
+        self.timing = timing  # whether to record status and duration
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.worker = None
+        self.lock = threading.Lock()
+        self.n_dropped = 0  # records dropped because the queue was full
+
+    @property
+    def enabled(self) -> bool:
+        """Check whether requests are captured."""
+        return bool(self.path) and self.rate > 0
+
+    @contextmanager
+    def capture(self, endpoint: str, headers, request_key: tuple = None):
+        """
+        Capture the request handled within the block, if sampled;
+        its schema and text are added with describe().
+        Retries of a request share the same `request_key` (see idempotency).
+        """
+        if not self.enabled or random.random() >= self.rate:
+            yield
+            return
+        source_name = headers.get("source-name", "").lower()
+        record = {
+            "time": round(time.time(), 3),
+            "endpoint": endpoint,
+            "form": anonymize(f"{source_name}:{headers.get('source-origin')}"),
+            "request": anonymize(request_key) if request_key else None,
+            "headers": {
+                name: headers[name]
+                for name in RECORDED_HEADERS
+                if headers.get(name) is not None
+            },
+        }
+        token = captured_request.set(record)
+        start = time.perf_counter()
+        status_code = 200
+        try:
+            yield
+        except Exception as e:
+            status_code = getattr(e, "status_code", 500)
+            raise
+        finally:
+            captured_request.reset(token)
+            if self.timing:
+                record["status_code"] = status_code
+                record["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self.put(record)
+
+    def describe(self, schema, text: str):
+        """
+        Add the shape of the schema and text to the captured request, if any;
+        never fails, capture must not affect the request
+        """
+        captured = captured_request.get()
+        if captured is None:
+            return
+        try:
+            captured.update(
+                {
+                    "source": schema.source.value,
+                    "schema_version": anonymize(schema.version_id),
+                    "n_labels": [
+                        sum(record.level == level for record in schema.data)
+                        for level in range(1, schema.n_levels + 1)
+                    ],
+                    "text_length": len(text or ""),
+                    # the language is detected by the writer thread, then the text dropped
+                    "_text": text or "",
+                }
+            )
+        except Exception as e:
+            logger.debug(f"Could not describe captured request: {e}")
+
+    @staticmethod
+    def detect_language(record: dict):
+        """Replace the text of a record with its language, None if it failed."""
+        if "_text" not in record:
+            return
+        text = record.pop("_text")
+        try:
+            record["language"] = language_detector.get_language(text)
+        except Exception:
+            record["language"] = None
+
+    def put(self, record: dict):
+        """Queue a record to be written, drop it if the queue is full."""
+        self.start_worker()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.n_dropped += 1
+
+    def start_worker(self):
+        """Start the thread writing records, once."""
+        if self.worker is None:
+            with self.lock:
+                if self.worker is None:
+                    self.worker = threading.Thread(
+                        target=self.write, name="request-capture", daemon=True
+                    )
+                    self.worker.start()
+
+    def write(self):
+        """Append queued records to the capture file, until None is queued."""
+        with open(self.path, "ab") as file:
+            stopped = False
+            while not stopped:
+                records = [self.queue.get()]
+                while len(records) < 1000:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stopped = None in records
+                for record in records:
+                    if record is not None:
+                        self.detect_language(record)
+                file.write(
+                    b"".join(
+                        orjson.dumps(record) + b"\n"
+                        for record in records
+                        if record is not None
+                    )
+                )
+                file.flush()
+
+    def close(self):
+        """Write the records still queued and stop the thread."""
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join(timeout=5)
+            if self.n_dropped:
+                logger.warning(
+                    f"Request capture dropped {self.n_dropped} records, queue was full."
+                )
+
+
+request_capture = RequestCapture(
+    path=os.getenv("REQUEST_CAPTURE_PATH"),
+    rate=float(os.getenv("REQUEST_CAPTURE_RATE", 1.0)),
+    timing=os.getenv("REQUEST_CAPTURE_TIMING", "false").lower() == "true",
+)
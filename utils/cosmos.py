@@ -1,18 +1,28 @@
 import os
+import threading
 import azure.cosmos.cosmos_client as cosmos_client
 from utils.sources import Source
 from urllib.parse import urlparse
 
+cosmos_container_client_ = None
+cosmos_lock = threading.Lock()
 
-# initialize CosmosDB
-client_ = cosmos_client.CosmosClient(
-    os.getenv("COSMOS_URL"),
-    {"masterKey": os.getenv("COSMOS_KEY")},
-    user_agent="qfa-api",
-    user_agent_overwrite=True,
-)
-cosmos_db = client_.get_database_client("qfa")
-cosmos_container_client = cosmos_db.get_container_client("qfa-schema")
+
+def get_cosmos_container_client():
+    """Get the CosmosDB container of classification schemas, connect on first use."""
+    global cosmos_container_client_
+    if cosmos_container_client_ is None:
+        with cosmos_lock:
+            if cosmos_container_client_ is None:
+                client_ = cosmos_client.CosmosClient(
+                    os.getenv("COSMOS_URL"),
+                    {"masterKey": os.getenv("COSMOS_KEY")},
+                    user_agent="qfa-api",
+                    user_agent_overwrite=True,
+                )
+                cosmos_db = client_.get_database_client("qfa")
+                cosmos_container_client_ = cosmos_db.get_container_client("qfa-schema")
+    return cosmos_container_client_
 
 
 def cosmos_source_id(source: Source, source_origin: str) -> str:
@@ -1,6 +1,8 @@
+import threading
 import requests
 import urllib
 from fastapi import HTTPException
+from utils.resilience import get_breaker, get_timeout
 
 
 def GetParentID(entity: str, record: dict) -> str:
@@ -63,6 +65,11 @@ def http_build_query(data):
     return urllib.parse.urlencode(r_urlencode(data))
 
 
+def link_attribute(link: str) -> str:
+    """Get the attribute name of a link field, e.g. 'Type' -> 'typeId'."""
+    return link[0].lower() + link[1:] + "Id"
+
+
 class EspoAPI:
     """EspoCRM API Client"""
 
@@ -74,6 +81,14 @@ class EspoAPI:
         self.url = url
         self.api_key = api_key
         self.status_code = None
+        self.local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        """HTTP session of the calling thread, requests.Session is not thread-safe."""
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
 
     def request(self, method, action, params=None):
         if params is None:
@@ -91,7 +106,7 @@ class EspoAPI:
         else:
             kwargs["url"] = kwargs["url"] + "?" + http_build_query(params)
 
-        response = requests.request(method, **kwargs)
+        response = get_breaker("espocrm", self.url).call(self.send, method, **kwargs)
 
         return {
             "status_code": response.status_code,
@@ -99,6 +114,55 @@ class EspoAPI:
             "content": response.json(),
         }
 
+    def send(self, method, **kwargs):
+        """Send a request, bounded by the request budget; raise on server errors."""
+        response = self.session.request(
+            method, timeout=get_timeout("espocrm"), **kwargs
+        )
+        if response.status_code >= 500:
+            raise HTTPException(
+                status_code=502,
+                detail=f"EspoCRM returned {response.status_code}: "
+                f"{self.parse_reason(response.headers)}",
+            )
+        return response
+
+    def iter_records(self, entity, select=None, where=None, page_size=200):
+        """
+        Iterate over the records of an entity, one page at a time.
+        Pages are fetched by id (keyset pagination), so that records which drop out
+        of the filter while iterating (e.g. because they were just updated) do not
+        shift the following pages.
+        """
+        where = list(where) if where else []
+        last_id = None
+        while True:
+            params = {
+                "maxSize": page_size,
+                "orderBy": "id",
+                "order": "asc",
+                "where": where,
+            }
+            if select:
+                params["select"] = ",".join(select)
+            if last_id:
+                params["where"] = where + [
+                    {"type": "greaterThan", "attribute": "id", "value": last_id}
+                ]
+            response = self.request("GET", entity, params)
+            if response["status_code"] != 200:
+                raise HTTPException(
+                    status_code=response["status_code"],
+                    detail=f"Failed to list {entity} records: {response['detail']}",
+                )
+            records = response["content"]["list"]
+            if not records:
+                break
+            yield records
+            if len(records) < page_size:
+                break
+            last_id = records[-1]["id"]
+
     def normalize_url(self, action):
         return self.url + self.url_path + action
 
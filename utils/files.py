@@ -0,0 +1,58 @@
+from typing import BinaryIO, Iterator
+import pandas as pd
+from fastapi import HTTPException
+
+CSV_CONTENT_TYPES = ["text/csv", "application/csv", "text/plain"]
+XLSX_CONTENT_TYPES = [
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+]
+
+
+def iter_csv_chunks(file: BinaryIO, chunksize: int) -> Iterator[pd.DataFrame]:
+    """Read a CSV file in chunks of rows, none if it is empty."""
+    try:
+        reader = pd.read_csv(file, chunksize=chunksize, dtype=str)
+    except pd.errors.EmptyDataError:
+        return
+    try:
+        yield from reader
+    except pd.errors.ParserError as e:
+        raise HTTPException(status_code=400, detail=f"Could not read CSV file: {e}")
+
+
+def iter_xlsx_chunks(file: BinaryIO, chunksize: int) -> Iterator[pd.DataFrame]:
+    """Read the first sheet of an XLSX file in chunks of rows, without loading it whole."""
+    # importing openpyxl is slow, only do it when an XLSX file is uploaded
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        columns = [str(column) for column in next(rows, [])]
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+
+def iter_table_chunks(
+    file: BinaryIO, content_type: str, chunksize: int
+) -> Iterator[pd.DataFrame]:
+    """
+    Read a CSV or XLSX file in chunks of rows, based on its content type.
+    """
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type in CSV_CONTENT_TYPES:
+        return iter_csv_chunks(file, chunksize)
+    elif content_type in XLSX_CONTENT_TYPES:
+        return iter_xlsx_chunks(file, chunksize)
+    raise HTTPException(
+        status_code=415,
+        detail=f"Content type '{content_type}' is not supported, upload a CSV or XLSX file.",
+    )
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from typing import Callable, Hashable
+import asyncio
+import time
+from fastapi import Response
+from starlette.concurrency import run_in_threadpool
+
+
+class IdempotencyCache:
+    """
+    Deduplicate requests by key: concurrent duplicates share one in-flight
+    computation, recently completed ones get the stored response
+    """
+
+    def __init__(self, ttl: float = 600.0, max_size: int = 10000):
+        self.ttl = ttl  # how long completed responses are kept, in seconds
+        self.max_size = max_size  # maximum number of completed responses kept
+        self.in_flight = {}  # key -> future of the running computation
+        self.completed = OrderedDict()  # key -> (expiry time, stored response)
+        self.n_shared = 0  # duplicates that waited for an in-flight computation
+        self.n_replayed = 0  # duplicates answered with a stored response
+
+    @staticmethod
+    def store(response: Response) -> tuple:
+        """Get what is needed to replay a response."""
+        return response.status_code, response.body, response.media_type
+
+    @staticmethod
+    def replay(stored: tuple) -> Response:
+        """Rebuild a response from what was stored."""
+        status_code, body, media_type = stored
+        return Response(content=body, status_code=status_code, media_type=media_type)
+
+    def evict(self):
+        """Remove expired responses and the oldest ones above max_size."""
+        now = time.monotonic()
+        while self.completed:
+            key, (expiry, _) = next(iter(self.completed.items()))
+            if expiry > now and len(self.completed) <= self.max_size:
+                break
+            self.completed.popitem(last=False)
+
+    async def run(self, key: Hashable | None, func: Callable, *args) -> Response:
+        """
+        Run func(*args) in a worker thread, unless a request with the same key
+        is in flight or recently completed. Requests without a key are never deduplicated.
+        Only successful responses are stored, failed requests can be retried.
+        """
+        if key is None:
+            return await run_in_threadpool(func, *args)
+
+        self.evict()
+        if key in self.completed:
+            self.n_replayed += 1
+            return self.replay(self.completed[key][1])
+        if key in self.in_flight:
+            self.n_shared += 1
+            return self.replay(await asyncio.shield(self.in_flight[key]))
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            response = await run_in_threadpool(func, *args)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, in case nobody is waiting
+            raise
+        finally:
+            del self.in_flight[key]
+        stored = self.store(response)
+        if response.status_code < 400 and self.ttl > 0:
+            self.completed[key] = (time.monotonic() + self.ttl, stored)
+        future.set_result(stored)
+        return response
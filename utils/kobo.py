@@ -1,3 +1,11 @@
+import os
+import requests
+from fastapi import HTTPException
+from utils.resilience import get_breaker, get_timeout, hedged_call
+
+KOBO_URL = os.getenv("KOBO_URL", "https://kobo.ifrc.org")
+
+
 def clean_kobo_data(kobo_data):
     """Clean Kobo data by removing group names and converting keys to lowercase."""
     kobo_data_clean = {k.lower(): v for k, v in kobo_data.items()}
@@ -6,3 +14,58 @@ def clean_kobo_data(kobo_data):
         new_key = key.split("/")[-1]
         kobo_data_clean[new_key] = kobo_data_clean.pop(key)
     return kobo_data_clean
+
+
+def get_kobo_asset(asset_id: str, token: str) -> dict:
+    """
+    Get a Kobo form (asset). The read is hedged, bounded by the request budget
+    and short-circuited when Kobo keeps failing.
+    """
+
+    def request():
+        response = requests.get(
+            f"{KOBO_URL}/api/v2/assets/{asset_id}/?format=json",
+            headers={"Authorization": f"Token {token}"},
+            timeout=get_timeout("kobo"),
+        )
+        if response.status_code >= 500:
+            raise HTTPException(
+                status_code=502, detail=f"Kobo returned {response.status_code}."
+            )
+        return response.json()
+
+    return get_breaker("kobo").call(hedged_call, request)
+
+
+def iter_kobo_submissions(asset_id: str, token: str, page_size: int = 1000):
+    """
+    Iterate over the submissions of a Kobo form, one page at a time
+    """
+    start = 0
+    while True:
+
+        def request():
+            response = requests.get(
+                f"{KOBO_URL}/api/v2/assets/{asset_id}/data/",
+                params={"format": "json", "limit": page_size, "start": start},
+                headers={"Authorization": f"Token {token}"},
+                timeout=get_timeout("kobo"),
+            )
+            if response.status_code >= 500:
+                raise HTTPException(
+                    status_code=502, detail=f"Kobo returned {response.status_code}."
+                )
+            if response.status_code != 200:
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=f"Failed to list submissions of Kobo form {asset_id}.",
+                )
+            return response.json()
+
+        submissions = get_breaker("kobo").call(request)["results"]
+        if not submissions:
+            break
+        yield submissions
+        if len(submissions) < page_size:
+            break
+        start += len(submissions)
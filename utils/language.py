@@ -0,0 +1,139 @@
+import os
+import re
+import threading
+from utils.logger import logger
+
+# most frequent English words, used when no language identification model is available
+ENGLISH_STOPWORDS = {
+    "a", "about", "all", "also", "an", "and", "are", "as", "at", "be", "because",
+    "but", "by", "can", "could", "do", "for", "from", "had", "has", "have", "he",
+    "her", "his", "how", "i", "if", "in", "is", "it", "its", "me", "my", "no",
+    "not", "of", "on", "or", "our", "please", "she", "so", "that", "the", "their",
+    "them", "there", "they", "this", "to", "us", "was", "we", "were", "what",
+    "when", "which", "who", "why", "will", "with", "would", "you", "your",
+}  # fmt: skip
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+
+class LanguageDetector:
+    """
+    Local language identification, to skip translation of text that is already
+    in English or has nothing to translate (e.g. only digits or emojis).
+    Uses a fastText language identification model (e.g. lid.176.ftz) if
+    LANGUAGE_DETECTION_MODEL is set, a stopword heuristic otherwise.
+    """
+
+    def __init__(self, model_path: str = None, threshold: float = 0.8):
+        self.model_path = model_path  # path to the fastText model
+        self.threshold = threshold  # minimum confidence to consider text English
+        self.model = None
+        self.model_loaded = False
+        self.lock = threading.Lock()
+        self.n_checked = 0  # texts checked
+        self.n_non_linguistic = 0  # texts without words
+        self.n_english = 0  # texts detected as English
+        self.n_errors = 0  # texts the model failed on, checked with the heuristic
+
+    def get_model(self):
+        """Get the fastText model, load it on first use; None if not available."""
+        if not self.model_loaded:
+            with self.lock:
+                if not self.model_loaded:
+                    if self.model_path:
+                        try:
+                            import fasttext
+
+                            self.model = fasttext.load_model(self.model_path)
+                        except (ImportError, ValueError) as e:
+                            logger.warning(
+                                f"Language detection model not available, "
+                                f"using stopword heuristic: {e}"
+                            )
+                    self.model_loaded = True
+        return self.model
+
+    def predict(self, text: str) -> tuple | None:
+        """
+        Get the most likely language of text and its probability with the fastText
+        model; None if the model is not available or failed
+        """
+        model = self.get_model()
+        if model is None:
+            return None
+        try:
+            # FastText.predict wraps the probabilities with np.array(copy=False),
+            # which raises on NumPy 2; the bound predictor returns them as they are
+            predictions = model.f.predict(text.replace("\n", " "), 1, 0.0, "strict")
+        except Exception as e:
+            with self.lock:
+                self.n_errors += 1
+                first_error = self.n_errors == 1
+            if first_error:
+                logger.warning(
+                    f"Language detection failed, using stopword heuristic: {e}"
+                )
+            return None
+        if not predictions:
+            return None
+        probability, label = predictions[0]
+        return label.replace("__label__", ""), probability
+
+    def is_english(self, text: str) -> bool:
+        """Check if text is English with enough confidence."""
+        prediction = self.predict(text)
+        if prediction is not None:
+            language, probability = prediction
+            return language == "en" and probability >= self.threshold
+        words = WORD_PATTERN.findall(text.lower())
+        # too few words to tell, better translate
+        if len(words) < 4 or not text.isascii():
+            return False
+        return sum(word in ENGLISH_STOPWORDS for word in words) / len(words) >= 0.25
+
+    def needs_translation(self, text: str) -> bool:
+        """
+        Check if text needs to be translated to English
+        """
+        non_linguistic = not WORD_PATTERN.search(text or "")
+        english = not non_linguistic and self.is_english(text)
+        with self.lock:
+            self.n_checked += 1
+            self.n_non_linguistic += non_linguistic
+            self.n_english += english
+        return not (non_linguistic or english)
+
+    def get_language(self, text: str) -> str | None:
+        """
+        Get the language of text as an ISO 639 code: "zxx" if it has no words,
+        None if unknown (without model, only English is recognized)
+        """
+        if not WORD_PATTERN.search(text or ""):
+            return "zxx"
+        prediction = self.predict(text)
+        if prediction is not None:
+            language, probability = prediction
+            return language if probability >= self.threshold else None
+        return "en" if self.is_english(text) else None
+
+    def summary(self) -> dict:
+        """
+        Return how often translation was skipped, as a dictionary
+        """
+        with self.lock:
+            n_skipped = self.n_non_linguistic + self.n_english
+            return {
+                "model": self.model_path if self.model is not None else "heuristic",
+                "checked": self.n_checked,
+                "skipped_non_linguistic": self.n_non_linguistic,
+                "skipped_english": self.n_english,
+                "detection_errors": self.n_errors,
+                "skipped_ratio": (
+                    round(n_skipped / self.n_checked, 3) if self.n_checked else 0.0
+                ),
+            }
+
+
+language_detector = LanguageDetector(
+    model_path=os.getenv("LANGUAGE_DETECTION_MODEL"),
+    threshold=float(os.getenv("LANGUAGE_DETECTION_THRESHOLD", 0.8)),
+)
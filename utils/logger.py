@@ -1,28 +1,165 @@
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+import contextvars
 import logging
 import os
+import queue
+import random
+import sys
+import threading
+import time
 from fastapi import HTTPException
 from dotenv import load_dotenv
 from opentelemetry._logs import set_logger_provider
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
 from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
-from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
 
 # load environment variables
 load_dotenv()
 
-# Set up logs export to Azure Application Insights
-logger_provider = LoggerProvider()
-set_logger_provider(logger_provider)
-exporter = AzureMonitorLogExporter(
-    connection_string=os.environ["APPLICATIONINSIGHTS_CONNECTION_STRING"]
-)
-logger_provider.add_log_record_processor(BatchLogRecordProcessor(exporter))
-
-# Attach LoggingHandler to root logger
-handler = LoggingHandler()
-logging.getLogger().addHandler(handler)
-logging.getLogger().setLevel(logging.NOTSET)
 logger = logging.getLogger(__name__)
+logger_provider = None
+logging_handler = None
+logging_listener = None
+logging_lock = threading.Lock()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of high-volume records (logged with extra={"sampled": True}),
+    records above INFO are always kept
+    """
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate  # fraction of high-volume records kept
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not getattr(record, "sampled", False):
+            return True
+        return self.rate >= 1.0 or random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hand records over to the listener thread without ever blocking:
+    when the queue is full, records are dropped and counted
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.n_dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.n_dropped += 1
+
+
+def setup_logging():
+    """
+    Set up logging to stdout and export to Azure Application Insights, if configured.
+    Handlers run in a listener thread, the request path only puts records in a queue.
+    Called once at application startup, not on import, so that tools and tests
+    do not need credentials nor pay for the exporter.
+    """
+    global logger_provider, logging_handler, logging_listener
+    with logging_lock:
+        if logger_provider is not None:
+            return
+        handlers = []
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.setFormatter(
+            logging.Formatter("%(asctime)s : %(levelname)s : %(message)s")
+        )
+        handlers.append(stdout_handler)
+
+        logger_provider = LoggerProvider()
+        set_logger_provider(logger_provider)
+        connection_string = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
+        if connection_string:
+            from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
+
+            exporter = AzureMonitorLogExporter(connection_string=connection_string)
+            logger_provider.add_log_record_processor(BatchLogRecordProcessor(exporter))
+            handlers.append(LoggingHandler(logger_provider=logger_provider))
+
+        # attach the queue handler to the root logger, handlers run in the listener thread
+        logging_handler = DroppingQueueHandler(
+            queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+        )
+        logging_handler.addFilter(
+            SamplingFilter(rate=float(os.getenv("LOG_SAMPLE_RATE", 1.0)))
+        )
+        logging_listener = QueueListener(
+            logging_handler.queue, *handlers, respect_handler_level=True
+        )
+        logging_listener.start()
+        logging.getLogger().addHandler(logging_handler)
+        logging.getLogger().setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        if not connection_string:
+            logger.warning(
+                "APPLICATIONINSIGHTS_CONNECTION_STRING not set, logs are not exported."
+            )
+
+
+def shutdown_logging():
+    """
+    Flush and stop logging, called at application shutdown.
+    """
+    global logger_provider, logging_handler, logging_listener
+    with logging_lock:
+        if logger_provider is not None:
+            logging.getLogger().removeHandler(logging_handler)
+            logging_listener.stop()  # handles the records left in the queue
+            logger_provider.shutdown()
+            if logging_handler.n_dropped:
+                print(
+                    f"{logging_handler.n_dropped} log records dropped, "
+                    "logging queue was full.",
+                    file=sys.stderr,
+                )
+            logger_provider, logging_handler, logging_listener = None, None, None
+
+
+request_fields = contextvars.ContextVar("request_fields", default=None)
+
+
+@contextmanager
+def log_request(event: str, extra_logs: dict = None):
+    """
+    Collect fields about a request within the block (see log_fields) and
+    log them as one summary record at the end, sampled if the request succeeded
+    """
+    fields = dict(extra_logs or {})
+    token = request_fields.set(fields)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield fields
+    except Exception as e:
+        failed = True
+        fields["status_code"] = getattr(e, "status_code", 500)
+        raise
+    finally:
+        request_fields.reset(token)
+        fields["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        logger.log(
+            logging.WARNING if failed else logging.INFO,
+            f"{event}: " + ", ".join(f"{key}={value}" for key, value in fields.items()),
+            extra={**fields, "sampled": not failed},
+        )
+
+
+def log_fields(**fields):
+    """
+    Add fields to the summary record of the current request, if any
+    """
+    current = request_fields.get()
+    if current is not None:
+        current.update(fields)
+
 
 # Silence noisy loggers
 logging.getLogger("requests").setLevel(logging.WARNING)
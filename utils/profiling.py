@@ -0,0 +1,282 @@
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+PROFILING_MODES = ("sampling", "cprofile")
+PROFILING_TRIGGERS = ("window", "header")
+# longest time a profiling session stays enabled, in seconds
+PROFILING_MAX_DURATION = float(os.getenv("PROFILING_MAX_DURATION", 600))
+# shortest time between samples, in seconds; shorter would slow down requests
+PROFILING_MIN_INTERVAL = 0.001
+# since Python 3.12, cProfile uses sys.monitoring, which sees the calls of all threads
+CPROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+def function_name(code) -> str:
+    """Name a function as `name (file:line)`."""
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class ProfilingSession:
+    """
+    Profiling of classification requests for a time window: all requests
+    (trigger "window") or only those with header profile-id set to the id of the
+    session (trigger "header").
+    In "sampling" mode, a background thread records the stacks of the threads
+    handling profiled requests every `interval` seconds; in "cprofile" mode,
+    every function call of a profiled request is timed, one request at a time
+    (requests arriving while another is profiled are not); since Python 3.12,
+    calls made meanwhile by other threads are timed too.
+    """
+
+    def __init__(
+        self,
+        mode: str = "sampling",
+        trigger: str = "window",
+        duration: float = 60,
+        interval: float = 0.005,
+    ):
+        if mode not in PROFILING_MODES:
+            raise ValueError(f"Unknown mode '{mode}', use 'sampling' or 'cprofile'.")
+        if trigger not in PROFILING_TRIGGERS:
+            raise ValueError(f"Unknown trigger '{trigger}', use 'window' or 'header'.")
+        if not 0 < duration <= PROFILING_MAX_DURATION:
+            raise ValueError(
+                f"Duration must be between 0 and {PROFILING_MAX_DURATION} seconds."
+            )
+        if not interval >= PROFILING_MIN_INTERVAL:
+            raise ValueError(
+                f"Interval must be at least {PROFILING_MIN_INTERVAL * 1000:g} millisecond."
+            )
+        self.id = str(uuid.uuid4())
+        self.mode = mode
+        self.trigger = trigger
+        self.interval = interval  # time between samples, in seconds
+        self.started_at = time.time()
+        self.expires = time.monotonic() + duration
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.n_requests = 0  # requests profiled
+        self.n_skipped = 0  # requests not profiled, another one was
+        # cprofile mode
+        self.stats = None  # pstats.Stats of the profiled requests
+        self.cprofile_lock = threading.Lock()  # held while a request is profiled
+        # sampling mode
+        self.threads = Counter()  # thread id -> profiled requests running in it
+        self.stacks = Counter()  # folded stack -> number of samples
+        self.n_samples = 0
+        if mode == "sampling":
+            threading.Thread(target=self.sample, name="profiler", daemon=True).start()
+
+    def is_active(self) -> bool:
+        """Check whether the session is still profiling."""
+        return not self.stopped.is_set() and time.monotonic() < self.expires
+
+    def matches(self, headers) -> bool:
+        """Check whether a request with these headers is to be profiled."""
+        return self.is_active() and (
+            self.trigger == "window" or headers.get("profile-id") == self.id
+        )
+
+    def stop(self):
+        """Stop profiling, keep the results."""
+        self.stopped.set()
+
+    @contextmanager
+    def profile(self):
+        """
+        Profile the request handled within the block, in this thread
+        """
+        if self.mode == "cprofile":
+            with self.profile_calls():
+                yield
+            return
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.threads[thread_id] += 1
+            self.n_requests += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.threads[thread_id] -= 1
+                if not self.threads[thread_id]:
+                    del self.threads[thread_id]
+
+    @contextmanager
+    def profile_calls(self):
+        """Time every function call within the block, unless another request is profiled."""
+        profile = None
+        if self.cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler (e.g. a debugger) is active
+                self.cprofile_lock.release()
+                profile = None
+        if profile is None:
+            with self.lock:
+                self.n_skipped += 1
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.cprofile_lock.release()
+            with self.lock:
+                self.n_requests += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def sample(self):
+        """Record the stacks of the threads handling profiled requests, until the session ends."""
+        while not self.stopped.wait(self.interval) and self.is_active():
+            with self.lock:
+                thread_ids = list(self.threads)
+            if not thread_ids:
+                continue
+            frames = sys._current_frames()
+            stacks = [
+                self.get_stack(frames[thread_id])
+                for thread_id in thread_ids
+                if thread_id in frames
+            ]
+            with self.lock:
+                self.stacks.update(stacks)
+                self.n_samples += len(stacks)
+
+    @staticmethod
+    def get_stack(frame) -> str:
+        """Get the stack of a frame as semicolon-separated functions, outermost first."""
+        names = []
+        while frame is not None:
+            names.append(function_name(frame.f_code))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def folded(self) -> str:
+        """
+        Get the sampled stacks in folded format, one `stack count` per line,
+        as read by flamegraph.pl, speedscope or inferno
+        """
+        with self.lock:
+            return "".join(
+                f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+            )
+
+    def dump_stats(self) -> bytes:
+        """Get the cProfile statistics in pstats format, as read by snakeviz or flameprof."""
+        with self.lock:
+            return marshal.dumps(self.stats.stats if self.stats else {})
+
+    def get_functions(self, limit: int) -> list:
+        """Get the functions taking the most time, with their own and total time."""
+        if self.mode == "cprofile":
+            if self.stats is None:
+                return []
+            functions = sorted(
+                self.stats.stats.items(), key=lambda item: item[1][3], reverse=True
+            )
+            return [
+                {
+                    "function": f"{name} ({os.path.basename(file)}:{line})",
+                    "calls": n_calls,
+                    "self_s": round(self_time, 6),
+                    "total_s": round(total_time, 6),
+                }
+                for (file, line, name), (_, n_calls, self_time, total_time, _) in (
+                    functions[:limit]
+                )
+            ]
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            names = stack.split(";")
+            own[names[-1]] += count
+            for name in set(names):
+                total[name] += count
+        return [
+            {
+                "function": name,
+                "self_samples": own[name],
+                "total_samples": count,
+                "total_ratio": round(count / self.n_samples, 3),
+            }
+            for name, count in total.most_common(limit)
+        ]
+
+    def summary(self, limit: int = 50) -> dict:
+        """
+        Return state of the session and its most time-consuming functions as a dictionary
+        """
+        with self.lock:
+            summary = {
+                "id": self.id,
+                "mode": self.mode,
+                "trigger": self.trigger,
+                "active": self.is_active(),
+                "started_at": self.started_at,
+                "remaining_s": round(max(0.0, self.expires - time.monotonic()), 1),
+                "requests": self.n_requests,
+                "skipped": self.n_skipped,
+            }
+            if self.mode == "sampling":
+                summary["interval_ms"] = self.interval * 1000
+                summary["samples"] = self.n_samples
+            elif CPROFILE_ALL_THREADS:
+                summary["note"] = (
+                    "On Python 3.12+, cProfile also times the calls made by other "
+                    "threads while a request is profiled, e.g. other requests."
+                )
+            summary["functions"] = self.get_functions(limit)
+        return summary
+
+
+class Profiler:
+    """
+    On-demand profiling of classification requests. At most one session runs at
+    a time; the last one is kept for its report. When no session is active,
+    requests only pay for one attribute check.
+    """
+
+    def __init__(self):
+        self.session = None  # current or last profiling session
+        self.lock = threading.Lock()
+
+    def start(self, **kwargs) -> ProfilingSession:
+        """Start a profiling session, see ProfilingSession; fail if one is active."""
+        with self.lock:
+            if self.session is not None and self.session.is_active():
+                raise RuntimeError(
+                    f"Profiling session {self.session.id} is already active."
+                )
+            self.session = ProfilingSession(**kwargs)
+            return self.session
+
+    @contextmanager
+    def profile_request(self, headers):
+        """
+        Profile the request handled within the block if a session is active
+        and the request matches it
+        """
+        session = self.session
+        if session is None or not session.matches(headers):
+            yield
+            return
+        with session.profile():
+            yield
+
+
+profiler = Profiler()
@@ -0,0 +1,455 @@
+"""
+Replay captured classification requests (see utils/capture.py) against a local
+instance of the API, to measure performance changes on production-shaped traffic.
+
+    python -m utils.replay --capture requests.jsonl --scale 2 --output report.json
+
+The API is started on a local port with an in-memory schema store instead of
+CosmosDB, and local stand-ins for Kobo, EspoCRM and the Translator that answer
+after `--dependency-latency` milliseconds. Each captured form gets a stand-in
+schema with the same number of labels per level, whose version changes when the
+captured one did; texts are generated with the captured length and language
+(English or not). Requests are sent at the captured times, `--scale` times faster,
+or at a fixed `--rate`; throughput and latency percentiles are reported per form.
+Inference runs for real, with the classifier of the environment
+(CLASSIFIER_PROVIDER, CLASSIFIER_MODEL).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+import requests
+
+ENGLISH_WORDS = (
+    "the water in our village is not safe and we need help with food and "
+    "medicine because the clinic was closed last week so please tell us when "
+    "it will open again"
+).split()
+OTHER_WORDS = (
+    "maji katika kijiji chetu si salama tunahitaji msaada wa chakula na dawa "
+    "kwa sababu kliniki ilifungwa wiki iliyopita tafadhali tuambieni lini "
+    "itafunguliwa tena"
+).split()
+API_KEY = "replay"
+
+
+def make_text(length: int, language: str | None, rng: random.Random) -> str:
+    """Generate a text of a given length, English if the captured text was."""
+    if language == "zxx":
+        return "".join(rng.choice("0123456789") for _ in range(length))
+    words = ENGLISH_WORDS if language == "en" else OTHER_WORDS
+    text = " ".join(rng.choice(words) for _ in range(length // 3 + 1))
+    return text[:length]
+
+
+class Form:
+    """
+    Stand-in of a captured form: a Kobo form or a set of EspoCRM entities with
+    the same number of labels per level
+    """
+
+    def __init__(self, form_id: str, source: str, headers: dict, n_labels: List[int]):
+        self.form_id = form_id
+        self.source = source
+        self.fields = [
+            headers.get(f"source-level{level}", f"Level{level}") for level in [1, 2, 3]
+        ]
+        self.version = "initial"  # version of the schema, as captured
+        self.server = None  # EspoCRM stand-in of the form
+        # labels of each level, children spread evenly over the parents
+        self.labels = []
+        for level, n in enumerate(n_labels, start=1):
+            parents = [id for id, _, _ in self.labels[-1]] if self.labels else [None]
+            self.labels.append(
+                [
+                    (f"{level}-{i}", f"Category {level}.{i}", parents[i % len(parents)])
+                    for i in range(n)
+                ]
+            )
+
+    def kobo_asset(self) -> dict:
+        """Get the form as a Kobo asset."""
+        survey, choices = [], []
+        filters = [None, "parent1=${{{0}}}", "parent1=${{{0}}} and parent2=${{{1}}}"]
+        for level, labels in enumerate(self.labels, start=1):
+            question = {
+                "type": "select_one",
+                "name": self.fields[level - 1],
+                "select_from_list_name": f"list{level}",
+            }
+            if filters[level - 1]:
+                question["choice_filter"] = filters[level - 1].format(*self.fields)
+            survey.append(question)
+            for id, label, parent in labels:
+                choice = {"list_name": f"list{level}", "name": id, "label": [label]}
+                if parent:
+                    choice[f"parent{level - 1}"] = parent
+                choices.append(choice)
+        return {
+            "deployed_version_id": self.version,
+            "content": {"survey": survey, "choices": choices},
+        }
+
+    def espocrm_records(self, entity: str) -> List[dict]:
+        """Get the records of an EspoCRM entity of the form."""
+        if entity not in self.fields[: len(self.labels)]:
+            return []
+        level = self.fields.index(entity) + 1
+        parent_link = self.fields[level - 2][0].lower() + self.fields[level - 2][1:]
+        return [
+            {
+                "id": id,
+                "name": label,
+                "modifiedAt": self.version,
+                **({f"{parent_link}Id": parent} if parent else {}),
+            }
+            for id, label, parent in self.labels[level - 1]
+        ]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answer Kobo, EspoCRM and Translator requests for the forms of the server."""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, content):
+        time.sleep(self.server.latency)
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[:3] == ["api", "v2", "assets"] and len(parts) == 4:
+            self.reply(self.server.forms[parts[3]].kobo_asset())
+        elif parts[:2] == ["api", "v1"] and len(parts) == 3:
+            records = self.server.form.espocrm_records(parts[2])
+            max_size = int(parse_qs(url.query).get("maxSize", [len(records)])[0])
+            self.reply({"list": records[:max_size], "total": len(records)})
+        else:
+            self.send_error(404)
+
+    def do_PATCH(self):
+        self.read_body()
+        self.reply({"results": [{"status_code": 200, "message": "Updated."}]})
+
+    def do_POST(self):
+        # Translator: return texts as they are
+        items = json.loads(self.read_body())
+        self.reply(
+            [{"translations": [{"text": item["text"], "to": "en"}]} for item in items]
+        )
+
+
+def start_stand_in(latency: float, **attributes) -> ThreadingHTTPServer:
+    """Start a stand-in server on a free local port, in the background."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def server_url(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_api(port: int, dependencies_url: str, timeout: float) -> subprocess.Popen:
+    """Start the API with the stand-ins in a separate process, wait until it is ready."""
+    env = {
+        **os.environ,
+        "API_KEY": API_KEY,
+        "SCHEMA_STORE": "memory",
+        "CACHE_BACKEND": "memory",
+        "KOBO_URL": dependencies_url,
+        "TRANSLATOR_URL": dependencies_url,
+        "MSCOGNITIVE_KEY": "replay",
+        "APPLICATIONINSIGHTS_CONNECTION_STRING": "",
+        "REQUEST_CAPTURE_PATH": "",
+        "LOG_LEVEL": "WARNING",
+    }
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API exited with code {process.returncode}.")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/ready").status_code == 200:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"API not ready after {timeout}s.")
+
+
+def load_capture(path: str, limit: int = None) -> List[dict]:
+    """Load captured requests, in order of arrival."""
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    records.sort(key=lambda record: record["time"])
+    return records[:limit] if limit else records
+
+
+def make_forms(records: List[dict], latency: float) -> Dict[str, Form]:
+    """
+    Create the stand-in of each captured form, from its first request with a known
+    schema; requests of forms whose schema is unknown are skipped
+    """
+    forms = {}
+    for record in records:
+        if record["form"] in forms or not record.get("n_labels"):
+            continue
+        form = Form(
+            record["form"], record["source"], record["headers"], record["n_labels"]
+        )
+        form.version = record["schema_version"]
+        if form.source == "espocrm":
+            # the schema of an EspoCRM instance is identified by its host
+            form.server = start_stand_in(latency, form=form)
+        forms[record["form"]] = form
+    return forms
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    """Get a percentile of values, in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(len(values) * q), len(values) - 1)] * 1000, 1)
+
+
+class Replay:
+    """
+    Send captured requests to the API at their (scaled) times and measure them.
+    Latency is measured from the time a request is due, so that requests
+    waiting for a free connection are not measured as faster than they are.
+    """
+
+    def __init__(self, url: str, forms: Dict[str, Form], concurrency: int = 32):
+        self.url = url
+        self.forms = forms
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.local = threading.local()
+        self.rng = random.Random(0)
+        self.request_ids = {}  # captured request hash -> replayed request id
+        self.submission_ids = itertools.count(1)
+        self.results = []  # (form, due time, latency in seconds, status code)
+        self.lock = threading.Lock()
+
+    def build(self, record: dict, warmup: bool = False) -> tuple:
+        """
+        Build the headers and payload of a captured request; warmup requests get
+        an id of their own, so that the replayed request is not answered as a retry
+        """
+        form = self.forms[record["form"]]
+        if record.get("schema_version"):
+            form.version = record["schema_version"]
+        headers = {
+            **record["headers"],
+            "API-KEY": API_KEY,
+            "source-authorization": "replay",
+            "source-origin": (server_url(form.server) if form.server else form.form_id),
+        }
+        # retries of a request are replayed with the same id
+        request_id = next(self.submission_ids)
+        if record.get("request") and not warmup:
+            request_id = self.request_ids.setdefault(record["request"], request_id)
+        text = make_text(
+            record.get("text_length", 100), record.get("language"), self.rng
+        )
+        if form.source == "kobo":
+            payload = {"_id": request_id, headers.get("source-text", "text"): text}
+        else:
+            headers["idempotency-key"] = str(request_id)
+            payload = {"text": text}
+        return headers, payload
+
+    def send(self, form: str, headers: dict, payload: dict, due: float):
+        """Send a request and record its latency."""
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        try:
+            status_code = self.local.session.post(
+                f"{self.url}/classify-text", headers=headers, json=payload
+            ).status_code
+        except requests.RequestException:
+            status_code = None
+        with self.lock:
+            self.results.append((form, due, time.perf_counter() - due, status_code))
+
+    def warmup(self, records: List[dict]):
+        """Send one request per form, not measured, so that schemas are loaded."""
+        seen = set()
+        for record in records:
+            if record["form"] in self.forms and record["form"] not in seen:
+                seen.add(record["form"])
+                headers, payload = self.build(record, warmup=True)
+                requests.post(
+                    f"{self.url}/classify-text", headers=headers, json=payload
+                )
+        self.results.clear()
+
+    def run(self, records: List[dict], scale: float = 1.0, rate: float = None):
+        """Send requests at their captured times divided by `scale`, or at a fixed rate."""
+        start = time.perf_counter()
+        for i, record in enumerate(records):
+            if record["form"] not in self.forms:
+                continue
+            offset = i / rate if rate else (record["time"] - records[0]["time"]) / scale
+            due = start + offset
+            time.sleep(max(0.0, due - time.perf_counter()))
+            headers, payload = self.build(record)
+            self.executor.submit(self.send, record["form"], headers, payload, due)
+        self.executor.shutdown(wait=True)
+
+    def reports(self, records: List[dict]) -> List[dict]:
+        """Report throughput and latency of the requests of each form, and of all."""
+        captured = {}
+        for record in records:
+            if record.get("duration_ms") is not None:
+                captured.setdefault(record["form"], []).append(
+                    record["duration_ms"] / 1000
+                )
+        groups = {}
+        for result in self.results:
+            groups.setdefault(result[0], []).append(result)
+        groups["all"] = self.results
+        reports = []
+        for form, results in sorted(groups.items(), key=lambda item: -len(item[1])):
+            latencies = [latency for _, _, latency, _ in results]
+            elapsed = max(due + latency for _, due, latency, _ in results) - min(
+                due for _, due, _, _ in results
+            )
+            reports.append(
+                {
+                    "form": form,
+                    "source": self.forms[form].source if form in self.forms else "",
+                    "requests": len(results),
+                    "errors": sum(
+                        status is None or status >= 400 for *_, status in results
+                    ),
+                    "requests_per_second": (
+                        round(len(results) / elapsed, 2) if elapsed else None
+                    ),
+                    "latency_p50_ms": percentile(latencies, 0.5),
+                    "latency_p95_ms": percentile(latencies, 0.95),
+                    "latency_p99_ms": percentile(latencies, 0.99),
+                    "captured_p50_ms": percentile(
+                        (
+                            sum(captured.values(), [])
+                            if form == "all"
+                            else captured.get(form, [])
+                        ),
+                        0.5,
+                    ),
+                }
+            )
+        return reports
+
+
+def print_reports(reports: List[dict]):
+    """Print reports as a table, one row per form."""
+    columns = list(reports[0].keys())
+    widths = [
+        max(len(column), *(len(str(report[column])) for report in reports))
+        for column in columns
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for report in reports:
+        print(
+            "  ".join(
+                str(report[column]).ljust(width)
+                for column, width in zip(columns, widths)
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay captured classification requests against a local API."
+    )
+    parser.add_argument(
+        "--capture", required=True, help="captured requests (JSON lines)"
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="replay this many times faster"
+    )
+    parser.add_argument(
+        "--rate", type=float, help="requests per second, instead of captured times"
+    )
+    parser.add_argument("--limit", type=int, help="replay only the first requests")
+    parser.add_argument(
+        "--concurrency", type=int, default=32, help="maximum requests in flight"
+    )
+    parser.add_argument(
+        "--dependency-latency",
+        type=float,
+        default=50,
+        help="response time of the stand-ins, in milliseconds",
+    )
+    parser.add_argument("--port", type=int, default=8765, help="port of the API")
+    parser.add_argument(
+        "--startup-timeout", type=float, default=600, help="seconds to wait for the API"
+    )
+    parser.add_argument("--output", help="save reports to this JSON file")
+    args = parser.parse_args()
+
+    records = load_capture(args.capture, args.limit)
+    latency = args.dependency_latency / 1000
+    forms = make_forms(records, latency)
+    dependencies = start_stand_in(
+        latency, forms={id: form for id, form in forms.items() if not form.server}
+    )
+    api = start_api(args.port, server_url(dependencies), args.startup_timeout)
+    try:
+        replay = Replay(
+            f"http://127.0.0.1:{args.port}", forms, concurrency=args.concurrency
+        )
+        replay.warmup(records)
+        replay.run(records, scale=args.scale, rate=args.rate)
+    finally:
+        api.terminate()
+        api.wait()
+    reports = replay.reports(records)
+    print_reports(reports)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from typing import Callable
+import contextvars
+import os
+import threading
+import time
+from fastapi import HTTPException
+from utils.logger import logger
+
+# timeout of a single call to each dependency, in seconds
+DEPENDENCY_TIMEOUTS = {
+    "kobo": float(os.getenv("KOBO_TIMEOUT", 10)),
+    "espocrm": float(os.getenv("ESPOCRM_TIMEOUT", 10)),
+    "translator": float(os.getenv("TRANSLATOR_TIMEOUT", 10)),
+    "cosmos": float(os.getenv("COSMOS_TIMEOUT", 5)),
+    "openai": float(os.getenv("OPENAI_TIMEOUT", 20)),
+    "cache": float(os.getenv("CACHE_TIMEOUT", 0.5)),
+}
+# time budget of one classification request, in seconds
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", 60))
+# send a second identical read if the first has not answered after this time, 0 to disable
+HEDGE_AFTER = float(os.getenv("HEDGE_AFTER", 2))
+
+budget_deadline = contextvars.ContextVar("budget_deadline", default=None)
+
+
+@contextmanager
+def request_budget(seconds: float = REQUEST_BUDGET):
+    """
+    Limit the total time spent calling dependencies within the block
+    """
+    token = budget_deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        budget_deadline.reset(token)
+
+
+def get_timeout(dependency: str) -> float:
+    """
+    Get the timeout of a call to a dependency: its own timeout, capped by
+    what is left of the request budget. Raise 504 if the budget is exhausted.
+    """
+    timeout = DEPENDENCY_TIMEOUTS[dependency]
+    deadline = budget_deadline.get()
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise HTTPException(
+                status_code=504,
+                detail=f"Request time budget exhausted before calling {dependency}.",
+            )
+        timeout = min(timeout, remaining)
+    return timeout
+
+
+class CircuitOpenError(HTTPException):
+    """Raised when a dependency is failing and calls to it are short-circuited."""
+
+    def __init__(self, name: str):
+        super().__init__(
+            status_code=503,
+            detail=f"{name} is unavailable, try again later.",
+        )
+
+
+class CircuitBreaker:
+    """
+    Fail fast when a dependency keeps failing: after `failure_threshold`
+    consecutive failures, calls are rejected for `reset_timeout` seconds, then
+    one trial call is let through to check whether the dependency recovered.
+    Client errors (status codes below 500, except timeouts and throttling)
+    do not count as failures.
+    """
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.n_failures = 0  # consecutive failures
+        self.opened_at = None  # time the circuit was opened, None if closed
+        self.trial_running = False  # True while a trial call is running
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_failure(exception: Exception) -> bool:
+        """Check if an exception means the dependency is failing."""
+        status_code = getattr(exception, "status_code", None)
+        if isinstance(status_code, int):
+            return status_code >= 500 or status_code in [408, 429]
+        return True
+
+    def before_call(self):
+        """Reject the call if the circuit is open."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if (
+                time.monotonic() - self.opened_at < self.reset_timeout
+                or self.trial_running
+            ):
+                raise CircuitOpenError(self.name)
+            self.trial_running = True
+
+    def after_call(self, exception: Exception = None):
+        """Record the outcome of a call, open or close the circuit."""
+        with self.lock:
+            self.trial_running = False
+            if exception is None or not self.is_failure(exception):
+                if self.opened_at is not None:
+                    logger.info(f"{self.name} recovered, closing circuit.")
+                self.n_failures = 0
+                self.opened_at = None
+                return
+            self.n_failures += 1
+            if self.opened_at is not None or self.n_failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(
+                        f"{self.name} failed {self.n_failures} times in a row, "
+                        f"opening circuit for {self.reset_timeout}s: {exception}"
+                    )
+                self.opened_at = time.monotonic()
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) through the circuit breaker
+        """
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.after_call(e)
+            raise
+        self.after_call()
+        return result
+
+    def summary(self) -> dict:
+        """
+        Return the state of the circuit as a dictionary
+        """
+        with self.lock:
+            return {
+                "state": "open" if self.opened_at is not None else "closed",
+                "consecutive_failures": self.n_failures,
+            }
+
+
+breakers = {}  # circuit breakers by dependency (and host)
+breakers_lock = threading.Lock()
+
+
+def get_breaker(dependency: str, host: str = None) -> CircuitBreaker:
+    """
+    Get the circuit breaker of a dependency, per host for self-hosted ones (EspoCRM)
+    """
+    name = f"{dependency} ({host})" if host else dependency
+    with breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)),
+                reset_timeout=float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30)),
+            )
+        return breakers[name]
+
+
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+def hedged_call(func: Callable, hedge_after: float = HEDGE_AFTER):
+    """
+    Call func(); if it has not returned after `hedge_after` seconds, call it
+    again in parallel and return whichever succeeds first.
+    Only use for idempotent reads.
+    """
+    if not hedge_after:
+        return func()
+    futures = [hedge_executor.submit(contextvars.copy_context().run, func)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        futures.append(hedge_executor.submit(contextvars.copy_context().run, func))
+    error = None
+    for future in as_completed(futures):
+        try:
+            return future.result()
+        except Exception as e:
+            error = e
+    raise error
@@ -0,0 +1,324 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import copy
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from utils.cosmos import get_cosmos_container_client
+from utils.resilience import get_breaker, get_timeout
+
+# maximum number of last-seen documents kept for conditional reads
+SCHEMA_STORE_CACHE_SIZE = int(os.getenv("SCHEMA_STORE_CACHE_SIZE", 1000))
+
+
+class SchemaNotFoundError(Exception):
+    """Raised when a classification schema is not in the store."""
+
+
+class SchemaStore(ABC):
+    """
+    Store of classification schema documents.
+    Keeps the last-seen version of the most recently used documents, so that
+    re-reads only transfer the document if its ETag changed.
+    """
+
+    partition_key_path = "source"  # document field used as partition key
+    # types of the documents stored next to the schemas, which are not schemas
+    derived_types = ("supervised-model",)
+
+    def __init__(self, cache_size: int = SCHEMA_STORE_CACHE_SIZE):
+        self.cache = OrderedDict()  # last-seen documents, by (partition key, id)
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.n_reads = 0  # number of reads
+        self.n_not_modified = 0  # number of reads answered from cache
+
+    def remember(self, document: dict):
+        """Keep the last-seen version of a document, forget the least recently used."""
+        key = (document[self.partition_key_path], document["id"])
+        self.cache[key] = document
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def read(self, id: str, partition_key: str) -> dict:
+        """
+        Read a document, re-using the cached version if it was not modified.
+        Raises SchemaNotFoundError if the document does not exist.
+        """
+        with self.lock:
+            cached = self.cache.get((partition_key, id))
+        document = self._read(
+            id, partition_key, etag=cached["_etag"] if cached else None
+        )
+        with self.lock:
+            self.n_reads += 1
+            if document is None:
+                self.n_not_modified += 1
+                document = cached
+            self.remember(document)
+        return copy.deepcopy(document)
+
+    def upsert(self, document: dict) -> dict:
+        """
+        Create or replace a document in a single round trip.
+        """
+        document = self._upsert(document)
+        with self.lock:
+            self.remember(document)
+        return copy.deepcopy(document)
+
+    def delete(self, id: str, partition_key: str):
+        """
+        Delete a document, if it exists.
+        """
+        with self.lock:
+            self.cache.pop((partition_key, id), None)
+        self._delete(id, partition_key)
+
+    def list_schemas(self, limit: int = 100) -> list:
+        """
+        List the schema documents (not their derived data), most recently modified
+        first; later reads of these documents cost only a version check.
+        """
+        documents = self._list_schemas(limit)
+        with self.lock:
+            for document in reversed(documents):
+                self.remember(document)
+        return copy.deepcopy(documents)
+
+    def summary(self) -> dict:
+        """
+        Return how many reads were answered from the last-seen documents, as a dictionary
+        """
+        with self.lock:
+            return {
+                "backend": type(self).__name__,
+                "size": len(self.cache),
+                "reads": self.n_reads,
+                "not_modified": self.n_not_modified,
+                "not_modified_ratio": (
+                    round(self.n_not_modified / self.n_reads, 3)
+                    if self.n_reads
+                    else 0.0
+                ),
+            }
+
+    @abstractmethod
+    def _read(self, id: str, partition_key: str, etag: str = None) -> dict | None:
+        """Read a document, return None if its ETag matches `etag`."""
+
+    @abstractmethod
+    def _list_schemas(self, limit: int) -> list:
+        """List up to `limit` schema documents, most recently modified first."""
+
+    @abstractmethod
+    def _upsert(self, document: dict) -> dict:
+        """Create or replace a document, return it with its new ETag."""
+
+    @abstractmethod
+    def _delete(self, id: str, partition_key: str):
+        """Delete a document, if it exists."""
+
+
+class CosmosSchemaStore(SchemaStore):
+    """
+    Schema store backed by a CosmosDB container
+    """
+
+    def __init__(self, container_client):
+        super().__init__()
+        self.container_client = container_client
+
+    def _read(self, id: str, partition_key: str, etag: str = None) -> dict | None:
+        kwargs = {}
+        if etag:
+            # If-None-Match: an unchanged document costs a 304 with an empty body
+            kwargs = {"etag": etag, "match_condition": MatchConditions.IfModified}
+        try:
+            document = get_breaker("cosmos").call(
+                self.container_client.read_item,
+                item=id,
+                partition_key=partition_key,
+                timeout=get_timeout("cosmos"),
+                **kwargs,
+            )
+        except CosmosResourceNotFoundError:
+            raise SchemaNotFoundError(id)
+        if etag and not document:
+            return None
+        return dict(document)
+
+    def _list_schemas(self, limit: int) -> list:
+        return [
+            dict(document)
+            for document in get_breaker("cosmos").call(
+                lambda: list(
+                    self.container_client.query_items(
+                        query="SELECT TOP @limit * FROM c WHERE NOT IS_DEFINED(c.type) "
+                        "OR NOT ARRAY_CONTAINS(@types, c.type) ORDER BY c._ts DESC",
+                        parameters=[
+                            {"name": "@limit", "value": limit},
+                            {"name": "@types", "value": list(self.derived_types)},
+                        ],
+                        enable_cross_partition_query=True,
+                        timeout=get_timeout("cosmos"),
+                    )
+                )
+            )
+        ]
+
+    def _upsert(self, document: dict) -> dict:
+        return dict(
+            get_breaker("cosmos").call(
+                self.container_client.upsert_item,
+                body=document,
+                timeout=get_timeout("cosmos"),
+            )
+        )
+
+    def _delete(self, id: str, partition_key: str):
+        try:
+            get_breaker("cosmos").call(
+                self.container_client.delete_item,
+                item=id,
+                partition_key=partition_key,
+                timeout=get_timeout("cosmos"),
+            )
+        except CosmosResourceNotFoundError:
+            pass
+
+
+class MemorySchemaStore(SchemaStore):
+    """
+    Schema store kept in memory, for tests and benchmarks
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.documents = {}
+
+    def _read(self, id: str, partition_key: str, etag: str = None) -> dict | None:
+        with self.lock:
+            if (partition_key, id) not in self.documents:
+                raise SchemaNotFoundError(id)
+            document = self.documents[(partition_key, id)]
+        if etag and document["_etag"] == etag:
+            return None
+        return copy.deepcopy(document)
+
+    def _list_schemas(self, limit: int) -> list:
+        with self.lock:
+            documents = [
+                document
+                for document in reversed(self.documents.values())
+                if document.get("type") not in self.derived_types
+            ]
+        return copy.deepcopy(documents[:limit])
+
+    def _upsert(self, document: dict) -> dict:
+        document = copy.deepcopy(document)
+        document["_etag"] = str(uuid.uuid4())
+        key = (document[self.partition_key_path], document["id"])
+        with self.lock:
+            # keep documents in order of last modification
+            self.documents.pop(key, None)
+            self.documents[key] = document
+        return copy.deepcopy(document)
+
+    def _delete(self, id: str, partition_key: str):
+        with self.lock:
+            self.documents.pop((partition_key, id), None)
+
+
+class SQLiteSchemaStore(SchemaStore):
+    """
+    Schema store kept in a local SQLite database, for tests and benchmarks
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        super().__init__()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS schemas ("
+            "partition_key TEXT, id TEXT, etag TEXT, body TEXT, "
+            "PRIMARY KEY (partition_key, id))"
+        )
+        self.connection.commit()
+
+    def _read(self, id: str, partition_key: str, etag: str = None) -> dict | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, body FROM schemas WHERE partition_key = ? AND id = ?",
+                (partition_key, id),
+            ).fetchone()
+        if row is None:
+            raise SchemaNotFoundError(id)
+        if etag and row[0] == etag:
+            return None
+        return json.loads(row[1])
+
+    def _list_schemas(self, limit: int) -> list:
+        # INSERT OR REPLACE gives modified rows a new rowid
+        placeholders = ", ".join("?" for _ in self.derived_types)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT body FROM schemas WHERE json_extract(body, '$.type') IS NULL "
+                f"OR json_extract(body, '$.type') NOT IN ({placeholders}) "
+                "ORDER BY rowid DESC LIMIT ?",
+                (*self.derived_types, limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _upsert(self, document: dict) -> dict:
+        document = copy.deepcopy(document)
+        document["_etag"] = str(uuid.uuid4())
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO schemas (partition_key, id, etag, body) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    document[self.partition_key_path],
+                    document["id"],
+                    document["_etag"],
+                    json.dumps(document),
+                ),
+            )
+            self.connection.commit()
+        return document
+
+    def _delete(self, id: str, partition_key: str):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM schemas WHERE partition_key = ? AND id = ?",
+                (partition_key, id),
+            )
+            self.connection.commit()
+
+
+schema_store_ = None
+schema_store_lock = threading.Lock()
+
+
+def get_schema_store() -> SchemaStore:
+    """
+    Get the schema store configured with SCHEMA_STORE (cosmos, memory or sqlite).
+    """
+    global schema_store_
+    if schema_store_ is None:
+        with schema_store_lock:
+            if schema_store_ is None:
+                backend = os.getenv("SCHEMA_STORE", "cosmos").lower()
+                if backend == "memory":
+                    schema_store_ = MemorySchemaStore()
+                elif backend == "sqlite":
+                    schema_store_ = SQLiteSchemaStore(
+                        os.getenv("SCHEMA_STORE_PATH", "qfa-schema.db")
+                    )
+                else:
+                    schema_store_ = CosmosSchemaStore(get_cosmos_container_client())
+    return schema_store_
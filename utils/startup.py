@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+import threading
+import time
+from utils.logger import logger
+
+
+class Startup:
+    """
+    Track application startup: duration of each step and readiness.
+    The app is ready once all steps are done and none failed.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.durations = {}  # duration of each completed step, in seconds
+        self.pending = set()  # steps still running in the background
+        self.errors = {}  # error of each failed step
+        self.started = False  # True once the synchronous steps are done
+        self.logged = False
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name: str):
+        """
+        Time a startup step
+        """
+        step_start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors[name] = str(e)
+            logger.error(f"Startup step {name} failed: {e}")
+        finally:
+            self.durations[name] = round(time.perf_counter() - step_start, 3)
+
+    def run_in_background(self, name: str, func, *args):
+        """
+        Run a startup step in a background thread; the app is not ready until it is done
+        """
+
+        def run():
+            with self.step(name):
+                func(*args)
+            with self.lock:
+                self.pending.discard(name)
+            self.log_if_ready()
+
+        with self.lock:
+            self.pending.add(name)
+        threading.Thread(target=run, name=f"startup-{name}", daemon=True).start()
+
+    def mark_started(self):
+        """
+        Mark the synchronous startup steps as done
+        """
+        self.started = True
+        self.log_if_ready()
+
+    def is_ready(self) -> bool:
+        """
+        Check whether all startup steps are done and succeeded
+        """
+        with self.lock:
+            return self.started and not self.pending and not self.errors
+
+    def log_if_ready(self):
+        """
+        Log the startup time breakdown, once
+        """
+        with self.lock:
+            if not self.started or self.pending or self.logged:
+                return
+            self.logged = True
+        total = round(time.perf_counter() - self.start_time, 3)
+        breakdown = ", ".join(f"{k} {v}s" for k, v in self.durations.items())
+        if self.errors:
+            logger.error(
+                f"Startup failed in {total}s, steps {', '.join(self.errors)} failed: "
+                f"{breakdown}."
+            )
+        else:
+            logger.info(f"Startup completed in {total}s: {breakdown}.")
+
+    def summary(self) -> dict:
+        """
+        Return readiness and duration of each step as a dictionary
+        """
+        with self.lock:
+            return {
+                "ready": self.started and not self.pending and not self.errors,
+                "pending": sorted(self.pending),
+                "durations": dict(self.durations),
+                "errors": dict(self.errors),
+            }
+
+
+startup = Startup()
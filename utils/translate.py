@@ -1,46 +1,300 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
 import os
+import queue
+import threading
+import time
 import uuid
 import requests
 from fastapi import HTTPException
 from dotenv import load_dotenv
+from utils.language import language_detector
+from utils.resilience import get_breaker, get_timeout
 
 load_dotenv()
 
+TRANSLATOR_URL = os.getenv(
+    "TRANSLATOR_URL", "https://api.cognitive.microsofttranslator.com"
+)
+# limits of the Translator /translate endpoint, per request
+TRANSLATOR_MAX_ITEMS = 1000
+TRANSLATOR_MAX_CHARACTERS = 50000
+
+
+class TranslationService:
+    """
+    Translation to English with MS translator.
+    Concurrent translation requests are grouped into multi-item calls and
+    results are kept in a size-bounded cache.
+    """
+
+    def __init__(
+        self,
+        max_items: int = 100,
+        max_characters: int = 10000,
+        max_wait: float = 0.01,
+        cache_size: int = 10000,
+        max_concurrent_calls: int = 4,
+    ):
+        self.max_items = min(max_items, TRANSLATOR_MAX_ITEMS)  # texts per call
+        self.max_characters = min(max_characters, TRANSLATOR_MAX_CHARACTERS)
+        self.max_wait = max_wait  # how long to wait for more texts to group, in seconds
+        self.cache_size = cache_size  # maximum number of cached translations
+        self.cache = OrderedDict()  # text -> translation, least recently used first
+        self.queue = queue.Queue()  # (text, future) waiting to be grouped
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_calls, thread_name_prefix="translate"
+        )
+        self.worker = None
+        self.lock = threading.Lock()
+        self.n_calls = 0  # calls to the Translator
+        self.n_texts = 0  # texts sent to the Translator
+        self.n_characters = 0  # characters sent to the Translator
+        self.n_cache_hits = 0  # texts answered from cache
+        self.latencies = deque(maxlen=1000)  # latency of the last calls, in seconds
+
+    def get_cached(self, text: str) -> str | None:
+        """Get a cached translation, None if not cached."""
+        with self.lock:
+            if text in self.cache:
+                self.cache.move_to_end(text)
+                self.n_cache_hits += 1
+                return self.cache[text]
+        return None
+
+    def set_cached(self, text: str, translation: str):
+        """Cache a translation, evict the least recently used ones above cache_size."""
+        with self.lock:
+            self.cache[text] = translation
+            self.cache.move_to_end(text)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def translate(self, text: str) -> str:
+        """
+        Translate one text, grouped with other concurrent requests
+        """
+        if not language_detector.needs_translation(text):
+            return text
+        cached = self.get_cached(text)
+        if cached is not None:
+            return cached
+        future = Future()
+        self.start_worker()
+        self.queue.put((text, future))
+        try:
+            return future.result(timeout=get_timeout("translator") + self.max_wait)
+        except TimeoutError:
+            raise HTTPException(status_code=504, detail="Translation timed out.")
+
+    def translate_many(self, texts: List[str]) -> List[str]:
+        """
+        Translate many texts in as few calls as possible
+        """
+        translations = {}
+        to_translate = []
+        for text in texts:
+            if text in translations:
+                continue
+            if not language_detector.needs_translation(text):
+                translations[text] = text
+                continue
+            cached = self.get_cached(text)
+            if cached is not None:
+                translations[text] = cached
+            else:
+                translations[text] = None
+                to_translate.append(text)
+        for chunk in self.chunks(to_translate):
+            for text, translation in zip(chunk, self.request(chunk)):
+                translations[text] = translation
+        return [translations[text] for text in texts]
+
+    def chunks(self, texts: List[str]):
+        """
+        Split texts in groups within the item and character limits of one call
+        """
+        chunk, n_characters = [], 0
+        for text in texts:
+            if chunk and (
+                len(chunk) >= self.max_items
+                or n_characters + len(text) > self.max_characters
+            ):
+                yield chunk
+                chunk, n_characters = [], 0
+            chunk.append(text)
+            n_characters += len(text)
+        if chunk:
+            yield chunk
+
+    def start_worker(self):
+        """Start the thread grouping concurrent requests, if not running."""
+        if self.worker is None:
+            with self.lock:
+                if self.worker is None:
+                    self.worker = threading.Thread(
+                        target=self.group_requests, name="translate", daemon=True
+                    )
+                    self.worker.start()
+
+    def group_requests(self):
+        """
+        Group queued texts until a limit or max_wait is reached, then translate them in one call
+        """
+        carry = None
+        while True:
+            text, future = carry if carry else self.queue.get()
+            carry = None
+            batch = {text: [future]}
+            n_characters = len(text)
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    text, future = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if text in batch:
+                    batch[text].append(future)
+                    continue
+                if n_characters + len(text) > self.max_characters:
+                    carry = (text, future)
+                    break
+                batch[text] = [future]
+                n_characters += len(text)
+            self.executor.submit(self.resolve, batch)
+
+    def resolve(self, batch: dict):
+        """Translate a group of texts and resolve the futures waiting for them."""
+        texts = list(batch.keys())
+        try:
+            translations = self.request(texts)
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        for text, translation in zip(texts, translations):
+            for future in batch[text]:
+                future.set_result(translation)
+
+    @staticmethod
+    def post(url: str, **kwargs) -> requests.Response:
+        """Send a request to MS translator, raise on server errors."""
+        response = requests.post(url, **kwargs)
+        if response.status_code >= 500:
+            raise HTTPException(
+                status_code=502,
+                detail=f"Translation service returned {response.status_code}.",
+            )
+        return response
+
+    def request(self, texts: List[str]) -> List[str]:
+        """
+        Translate texts in one call to MS translator and cache the results
+        """
+        constructed_url = f"{TRANSLATOR_URL}/translate"
+
+        params = {
+            "api-version": "3.0",
+            "from": [],
+            "to": ["en"],
+        }
+        headers = {
+            "Ocp-Apim-Subscription-Key": os.getenv("MSCOGNITIVE_KEY"),
+            "Ocp-Apim-Subscription-Region": "westeurope",
+            "Content-type": "application/json",
+            "X-ClientTraceId": str(uuid.uuid4()),
+        }
+
+        start = time.perf_counter()
+        response = get_breaker("translator").call(
+            self.post,
+            constructed_url,
+            params=params,
+            headers=headers,
+            json=[{"text": text} for text in texts],
+            timeout=get_timeout("translator"),
+        )
+        response = response.json()
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            self.n_calls += 1
+            self.n_texts += len(texts)
+            self.n_characters += sum(len(text) for text in texts)
+
+        if not isinstance(response, list) or len(response) != len(texts):
+            raise HTTPException(
+                status_code=500,
+                detail=f"Translation service is down, try with translate=false.",
+            )
+        translations = []
+        for text, item in zip(texts, response):
+            translated_text = item["translations"][0]["text"]
+            if not translated_text:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Translation service is down, try with translate=false.",
+                )
+            self.set_cached(text, translated_text)
+            translations.append(translated_text)
+        return translations
+
+    def summary(self) -> dict:
+        """
+        Return calls, characters, cache hits and latency percentiles as a dictionary
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                "calls": self.n_calls,
+                "texts": self.n_texts,
+                "characters": self.n_characters,
+                "cache_hits": self.n_cache_hits,
+                "cache_size": len(self.cache),
+                "latency_p50_ms": (
+                    round(latencies[len(latencies) // 2] * 1000, 1)
+                    if latencies
+                    else None
+                ),
+                "latency_p95_ms": (
+                    round(latencies[int(len(latencies) * 0.95)] * 1000, 1)
+                    if latencies
+                    else None
+                ),
+            }
+
+
+translation_service = TranslationService(
+    max_items=int(os.getenv("TRANSLATION_MAX_ITEMS", 100)),
+    max_characters=int(os.getenv("TRANSLATION_MAX_CHARACTERS", 10000)),
+    cache_size=int(os.getenv("TRANSLATION_CACHE_SIZE", 10000)),
+)
+
 
 def translate_text(text: str) -> str:
     """
     Translate some text using MS translator.
+    Text that is already in English or has no words is returned as is.
 
     Args:
         text (str): The text to translate.
     Returns:
         str: The translated message.
     """
-    constructed_url = "https://api.cognitive.microsofttranslator.com/translate"
-
-    params = {
-        "api-version": "3.0",
-        "from": [],
-        "to": ["en"],
-    }
-    headers = {
-        "Ocp-Apim-Subscription-Key": os.getenv("MSCOGNITIVE_KEY"),
-        "Ocp-Apim-Subscription-Region": "westeurope",
-        "Content-type": "application/json",
-        "X-ClientTraceId": str(uuid.uuid4()),
-    }
-
-    response = requests.post(
-        constructed_url,
-        params=params,
-        headers=headers,
-        json=[{"text": text}],
-    ).json()
-    translated_text = response[0]["translations"][0]["text"]
-
-    if not translated_text:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Translation service is down, try with translate=false.",
-        )
-    return translated_text
+    return translation_service.translate(text)
+
+
+def translate_texts(texts: List[str]) -> List[str]:
+    """
+    Translate many texts using MS translator, in as few calls as possible.
+
+    Args:
+        texts (list): The texts to translate.
+    Returns:
+        list: The translated messages, in the same order.
+    """
+    return translation_service.translate_many(texts)